@@ -0,0 +1,44 @@
+# Elige BCRYPT_ROUNDS para este host: el costo más alto cuyo checkpw mediano cabe en --target-ms
+import argparse
+import statistics
+import time
+
+import bcrypt
+
+
+def measure_verify_ms(rounds: int, samples: int) -> float:
+    password = b"calibration-password"
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        bcrypt.checkpw(password, hashed)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate(target_ms: float, min_rounds: int, max_rounds: int, samples: int) -> int:
+    chosen = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        elapsed = measure_verify_ms(rounds, samples)
+        print(f"rounds={rounds:2d}  verify={elapsed:8.1f} ms")
+        if elapsed > target_ms:
+            break
+        chosen = rounds
+    return chosen
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the bcrypt cost factor (BCRYPT_ROUNDS)")
+    parser.add_argument("--target-ms", type=float, default=250.0, help="Maximum verification time per login")
+    parser.add_argument("--min-rounds", type=int, default=10)
+    parser.add_argument("--max-rounds", type=int, default=16)
+    parser.add_argument("--samples", type=int, default=3)
+    args = parser.parse_args()
+
+    rounds = calibrate(args.target_ms, args.min_rounds, args.max_rounds, args.samples)
+    print(f"\nBCRYPT_ROUNDS={rounds}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+# Precio final: base + ganancia del proveedor + IVA; calculate_prices es la versión por lotes (numpy), mismo redondeo
+from typing import Sequence
+
+import numpy as np
+
+PROFIT_PERCENTAGE = "percentage"
+PROFIT_FIXED = "fixed"
+
+
+def calculate_price(base_price: float, profit_type: str, profit_value: float, iva_percentage: float) -> float:
+    final_price = base_price
+
+    # Add profit
+    if profit_type == PROFIT_PERCENTAGE:
+        final_price += final_price * (profit_value / 100)
+    else:  # fixed
+        final_price += profit_value
+
+    # Add IVA
+    final_price += final_price * (iva_percentage / 100)
+    return round(final_price, 2)
+
+
+def calculate_prices(
+    base_prices: Sequence[float],
+    profit_types: Sequence[str],
+    profit_values: Sequence[float],
+    iva_percentages: Sequence[float]
+) -> list:
+    base = np.asarray(base_prices, dtype=np.float64)
+    profit = np.asarray(profit_values, dtype=np.float64)
+    iva = np.asarray(iva_percentages, dtype=np.float64)
+    is_percentage = np.asarray(profit_types, dtype=object) == PROFIT_PERCENTAGE
+
+    final_prices = np.where(is_percentage, base + base * (profit / 100), base + profit)
+    final_prices = final_prices + final_prices * (iva / 100)
+    return [round(price, 2) for price in final_prices.tolist()]
@@ -1,25 +1,42 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Header, Query, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import IndexModel, UpdateOne, ReturnDocument, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import BulkWriteError, PyMongoError
+from gridfs.errors import NoFile
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr, ConfigDict
-from typing import List, Optional
+from pricing import PROFIT_FIXED, PROFIT_PERCENTAGE, calculate_price, calculate_prices
+from pydantic import BaseModel, Field, EmailStr, ConfigDict, TypeAdapter, ValidationError, AfterValidator, PlainSerializer
+from typing import Annotated, List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
 import base64
+import csv
+import hashlib
+import io
+import itertools
+import json
+import re
+import secrets
+import time
+import urllib.parse
+import asyncio
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
@@ -27,12 +44,422 @@ SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-product
 ALGORITHM = 'HS256'
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
+# Authenticated user cache (per process)
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '10000'))
+
+# Per-supplier product id sets used by order permission checks (per process)
+SUPPLIER_PRODUCTS_CACHE_TTL_SECONDS = float(os.environ.get('SUPPLIER_PRODUCTS_CACHE_TTL_SECONDS', '300'))
+SUPPLIER_PRODUCTS_CACHE_MAX_ENTRIES = int(os.environ.get('SUPPLIER_PRODUCTS_CACHE_MAX_ENTRIES', '1000'))
+
+# Serialized public category pages (per process)
+CATEGORY_CACHE_TTL_SECONDS = float(os.environ.get('CATEGORY_CACHE_TTL_SECONDS', '3600'))
+CATEGORY_CACHE_MAX_ENTRIES = int(os.environ.get('CATEGORY_CACHE_MAX_ENTRIES', '64'))
+# Version (ETag) of the category list kept per process; another worker's write shows up after at most this long
+COLLECTION_VERSION_CACHE_SECONDS = float(os.environ.get('COLLECTION_VERSION_CACHE_SECONDS', '2'))
+
+# Notifications are written by a background worker in batches
+NOTIFICATION_BATCH_SIZE = int(os.environ.get('NOTIFICATION_BATCH_SIZE', '500'))
+NOTIFICATION_BATCH_WINDOW_SECONDS = float(os.environ.get('NOTIFICATION_BATCH_WINDOW_SECONDS', '1.0'))  # also the coalescing window
+NOTIFICATION_QUEUE_MAX = int(os.environ.get('NOTIFICATION_QUEUE_MAX', '10000'))  # beyond this, write inline
+
+# Notification retention: read ones expire, and each user's feed is capped
+NOTIFICATION_READ_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_READ_RETENTION_DAYS', '30'))
+NOTIFICATION_MAX_PER_USER = int(os.environ.get('NOTIFICATION_MAX_PER_USER', '500'))
+NOTIFICATION_COMPACT_INTERVAL_SECONDS = float(os.environ.get('NOTIFICATION_COMPACT_INTERVAL_SECONDS', '3600'))
+
+# Server-sent events (/events)
+SSE_KEEPALIVE_SECONDS = float(os.environ.get('SSE_KEEPALIVE_SECONDS', '15'))
+SSE_QUEUE_MAX = int(os.environ.get('SSE_QUEUE_MAX', '100'))  # a subscriber further behind is told to resync
+SSE_TOKEN_EXPIRE_SECONDS = int(os.environ.get('SSE_TOKEN_EXPIRE_SECONDS', '60'))  # ?token= ends up in access logs
+
+# Password hashing runs on a dedicated thread pool of this size
+BCRYPT_MAX_WORKERS = int(os.environ.get('BCRYPT_MAX_WORKERS', '2'))
+# bcrypt work factor for new hashes; pick it with calibrate_bcrypt.py.
+# Stored hashes with a different cost are rehashed on the next successful login.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+
+# List endpoints return at most MAX_PAGE_SIZE items; the X-Next-Cursor header carries the next page token
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '1000'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+
+# Quotation file storage: 'gridfs' (default) or 'local' (content-addressed files under BLOB_STORE_PATH)
+BLOB_STORE = os.environ.get('BLOB_STORE', 'gridfs')
+BLOB_STORE_PATH = Path(os.environ.get('BLOB_STORE_PATH', str(ROOT_DIR / 'blobs')))
+BLOB_CHUNK_SIZE = 256 * 1024
+QUOTATION_MAX_BYTES = int(os.environ.get('QUOTATION_MAX_BYTES', str(20 * 1024 * 1024)))
+QUOTATION_MIGRATION_BATCH_SIZE = 10  # legacy quotations carry the whole file; keep batches small
+
+# Materialized admin counters are rebuilt from the collections this often
+STATS_RECONCILE_INTERVAL_SECONDS = float(os.environ.get('STATS_RECONCILE_INTERVAL_SECONDS', '3600'))
+
+# Delta sync for offline clients
+SYNC_MAX_ITEMS = int(os.environ.get('SYNC_MAX_ITEMS', '500'))  # per collection and call
+SYNC_CLOCK_SKEW_SECONDS = 5  # margin for writes still in flight when the token is issued
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', '30'))  # older tokens force a full resync
+
+# Admin exports read the collection in batches of this size
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '500'))
+
+# Bulk product import: rows per bulk_write and error rows echoed back
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_MAX_REPORTED_ERRORS = 1000
+# Admin repricing reads and rewrites products in batches of this size
+REPRICE_BATCH_SIZE = int(os.environ.get('REPRICE_BATCH_SIZE', '1000'))
+
+# Documents processed per round trip by startup data migrations
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '500'))
+
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # Create the main app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
+# Indexes required by the hot queries, created idempotently on startup
+REQUIRED_INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("role", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="role_created_at_id"),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("supplier_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="supplier_id_created_at_id"),
+        IndexModel([("category", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="category_created_at_id"),
+        IndexModel([("updated_at", ASCENDING), ("id", ASCENDING)], name="updated_at_id"),
+        IndexModel([("supplier_id", ASCENDING), ("updated_at", ASCENDING), ("id", ASCENDING)], name="supplier_id_updated_at_id"),
+        # Búsqueda: stemming en español, sin distinguir acentos; el nombre pesa más que la descripción
+        IndexModel(
+            [("name", TEXT), ("description", TEXT), ("sku", TEXT)],
+            name="text_search",
+            default_language="spanish",
+            weights={"name": 10, "sku": 5, "description": 1}
+        ),
+        IndexModel([("sku", ASCENDING)], name="sku"),
+        IndexModel([("supplier_id", ASCENDING), ("sku", ASCENDING)], name="supplier_id_sku"),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("client_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="client_id_created_at_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        # Una rama indexada por cada condición del feed de proveedores
+        IndexModel([("supplier_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="supplier_id_created_at_id"),
+        IndexModel([("assigned_to", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="assigned_to_created_at_id"),
+        IndexModel([("supplier_ids", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="supplier_ids_created_at_id"),
+        IndexModel([("has_custom", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="has_custom_created_at_id"),
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("updated_at", ASCENDING), ("id", ASCENDING)], name="updated_at_id"),
+        IndexModel([("client_id", ASCENDING), ("updated_at", ASCENDING), ("id", ASCENDING)], name="client_id_updated_at_id"),
+    ],
+    "notifications": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Un lote comparte milisegundo: id (UUIDv7) desempata
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_id_created_at_id"),
+        IndexModel([("user_id", ASCENDING), ("updated_at", ASCENDING), ("id", ASCENDING)], name="user_id_updated_at_id"),
+        IndexModel([("user_id", ASCENDING), ("read", ASCENDING)], name="user_id_read"),
+        # Solo las leídas tienen expires_at; las borra purge_expired_notifications (sin TTL, para dejar tombstones)
+        IndexModel([("expires_at", ASCENDING)], name="expires_at"),
+    ],
+    "categories": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("slug", ASCENDING)], name="slug_unique", unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("updated_at", ASCENDING), ("id", ASCENDING)], name="updated_at_id"),
+    ],
+    "tombstones": [
+        IndexModel([("deleted_at", ASCENDING), ("id", ASCENDING)], name="deleted_at_id"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "registration_requests": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="status_created_at_id"),
+        IndexModel([("email", ASCENDING), ("status", ASCENDING)], name="email_status"),
+    ],
+    "order_rollups": [
+        IndexModel(
+            [("day", ASCENDING), ("supplier_id", ASCENDING), ("category", ASCENDING), ("status", ASCENDING)],
+            name="bucket_unique", unique=True
+        ),
+        IndexModel([("category", ASCENDING), ("day", ASCENDING)], name="category_day"),
+    ],
+    "quotations": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("order_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="order_id_created_at_id"),
+    ],
+}
+
+# Indexes superseded by an entry above; dropped on startup if still present
+RETIRED_INDEXES = {
+    "users": ["role"],
+    "products": ["supplier_id", "category"],
+    "orders": ["client_id_created_at", "created_at", "supplier_id", "assigned_to"],
+    "registration_requests": ["status_created_at"],
+    "quotations": ["order_id"],
+    "notifications": ["user_id_created_at", "expires_at_ttl"],
+}
+
+# Query shapes reported by /admin/indexes; values are placeholders, only the shape matters
+HOT_QUERIES = [
+    {"name": "login", "collection": "users", "filter": {"email": "probe@example.com"}},
+    {"name": "current_user", "collection": "users", "filter": {"id": "probe"}},
+    {"name": "product_by_id", "collection": "products", "filter": {"id": "probe"}},
+    {"name": "supplier_products", "collection": "products", "filter": {"supplier_id": "probe"}, "sort": [("created_at", ASCENDING), ("id", ASCENDING)]},
+    {"name": "product_search", "collection": "products", "filter": {"$text": {"$search": "probe"}}},
+    {"name": "product_sku_prefix", "collection": "products", "filter": {"sku": {"$regex": "^PROBE"}}, "sort": [("sku", ASCENDING)]},
+    {"name": "order_by_id", "collection": "orders", "filter": {"id": "probe"}},
+    {"name": "client_orders", "collection": "orders", "filter": {"client_id": "probe"}, "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {"name": "all_orders", "collection": "orders", "filter": {}, "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {
+        "name": "supplier_orders",
+        "collection": "orders",
+        "filter": {"$or": [
+            {"supplier_id": "probe"},
+            {"assigned_to": "probe"},
+            {"supplier_ids": "probe"},
+            {"has_custom": True}
+        ]},
+        "sort": [("created_at", DESCENDING), ("id", DESCENDING)]
+    },
+    {"name": "user_notifications", "collection": "notifications", "filter": {"user_id": "probe"}, "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {"name": "category_by_slug", "collection": "categories", "filter": {"slug": "probe"}},
+    {"name": "pending_requests", "collection": "registration_requests", "filter": {"status": "pendiente"}, "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {"name": "order_quotations", "collection": "quotations", "filter": {"order_id": "probe"}, "sort": [("created_at", ASCENDING), ("id", ASCENDING)]},
+]
+
+@app.on_event("startup")
+async def ensure_indexes():
+    for collection_name, names in RETIRED_INDEXES.items():
+        for name in names:
+            try:
+                if name in await db[collection_name].index_information():
+                    await db[collection_name].drop_index(name)
+            except PyMongoError as e:
+                # Un índice viejo que no se pudo borrar no debe impedir el arranque
+                logger.error(f"Could not drop index {collection_name}.{name}: {e}")
+    
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        for index in indexes:
+            try:
+                await db[collection_name].create_indexes([index])
+            except PyMongoError as e:
+                # p.ej. duplicados previos en un índice único: no impedir el arranque
+                logger.error(f"Could not create index {collection_name}.{index.document['name']}: {e}")
+
+def _collect_plan_stages(plan, stages: list, index_names: list):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        if plan.get("indexName"):
+            index_names.append(plan["indexName"])
+        for value in plan.values():
+            _collect_plan_stages(value, stages, index_names)
+    elif isinstance(plan, list):
+        for item in plan:
+            _collect_plan_stages(item, stages, index_names)
+
+async def explain_hot_query(query: dict) -> dict:
+    cursor = db[query["collection"]].find(query["filter"], {"_id": 0})
+    if query.get("sort"):
+        cursor = cursor.sort(query["sort"])
+    explanation = await cursor.explain()
+    stages, index_names = [], []
+    _collect_plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {}), stages, index_names)
+    return {
+        "name": query["name"],
+        "collection": query["collection"],
+        "stages": stages,
+        "indexes_used": sorted(set(index_names)),
+        # Usa un índice, aunque lea los documentos (FETCH): ninguna de estas consultas es cubierta
+        "index_supported": "COLLSCAN" not in stages and bool(index_names),
+        "in_memory_sort": "SORT" in stages
+    }
+
+@app.on_event("startup")
+async def backfill_order_supplier_ids():
+    # Órdenes creadas antes de guardar supplier_ids/has_custom, por lotes y en orden de _id
+    query = {"supplier_ids": {"$exists": False}}
+    last_id = None
+    migrated = 0
+    try:
+        while True:
+            batch_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+            orders = await db.orders.find(batch_query, {"_id": 1, "products": 1}).sort("_id", ASCENDING).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+            if not orders:
+                break
+            last_id = orders[-1]["_id"]
+            
+            # Líneas antiguas sin supplier_id: resolver el dueño desde el catálogo
+            unresolved = {
+                line["product_id"]
+                for order in orders
+                for line in order.get("products", [])
+                if line.get("product_id") and not line.get("supplier_id")
+            }
+            owners = {}
+            if unresolved:
+                found = await db.products.find(
+                    {"id": {"$in": list(unresolved)}},
+                    {"_id": 0, "id": 1, "supplier_id": 1}
+                ).to_list(len(unresolved))
+                owners = {p["id"]: p["supplier_id"] for p in found}
+            
+            operations = []
+            for order in orders:
+                lines = [
+                    {**line, "supplier_id": line.get("supplier_id") or owners.get(line.get("product_id"))}
+                    for line in order.get("products", [])
+                ]
+                operations.append(UpdateOne({"_id": order["_id"]}, {"$set": order_supplier_fields(lines)}))
+            await db.orders.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+    except PyMongoError as e:
+        logger.error(f"supplier_ids backfill stopped after {migrated} orders: {e}")
+        return
+    
+    if migrated:
+        logger.info(f"Backfilled supplier_ids for {migrated} orders")
+
+@app.on_event("startup")
+async def backfill_updated_at():
+    # Documentos anteriores a updated_at: tomar created_at para que entren en la sincronización
+    for collection_name in ("products", "categories", "notifications"):
+        try:
+            result = await db[collection_name].update_many(
+                {"updated_at": {"$exists": False}},
+                [{"$set": {"updated_at": "$created_at"}}]
+            )
+            if result.modified_count and collection_name != "notifications":
+                await bump_collection_version(collection_name)
+        except PyMongoError as e:
+            logger.error(f"updated_at backfill failed for {collection_name}: {e}")
+
+# Campos de fecha que antes se guardaban como texto ISO
+TIMESTAMP_FIELDS = {
+    "users": ["created_at"],
+    "products": ["created_at", "updated_at"],
+    "orders": ["created_at", "updated_at"],
+    "quotations": ["created_at"],
+    "notifications": ["created_at", "updated_at"],
+    "categories": ["created_at", "updated_at"],
+    "registration_requests": ["created_at", "processed_at"],
+    "tombstones": ["deleted_at"],
+}
+
+@app.on_event("startup")
+async def migrate_timestamps_to_dates():
+    # Convertir fechas guardadas como texto a BSON date, por lotes y en orden de _id
+    for collection_name, fields in TIMESTAMP_FIELDS.items():
+        query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+        projection = {"_id": 1, **{field: 1 for field in fields}}
+        last_id = None
+        migrated = 0
+        try:
+            while True:
+                batch_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+                docs = await db[collection_name].find(batch_query, projection).sort("_id", ASCENDING).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+                if not docs:
+                    break
+                last_id = docs[-1]["_id"]
+                
+                operations = []
+                for doc in docs:
+                    changes = {}
+                    for field in fields:
+                        if isinstance(doc.get(field), str):
+                            try:
+                                changes[field] = parse_timestamp(doc[field])
+                            except ValueError:
+                                logger.warning(f"Unparseable {collection_name}.{field} on {doc['_id']}: {doc[field]!r}")
+                    if changes:
+                        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": changes}))
+                if operations:
+                    await db[collection_name].bulk_write(operations, ordered=False)
+                    migrated += len(operations)
+        except PyMongoError as e:
+            logger.error(f"Timestamp migration for {collection_name} stopped after {migrated} documents: {e}")
+            continue
+        
+        if migrated:
+            logger.info(f"Converted timestamps to dates on {migrated} {collection_name}")
+
+@app.on_event("startup")
+async def backfill_notification_expiry():
+    # Notificaciones leídas antes de la política de retención: cuentan desde hoy
+    try:
+        await db.notifications.update_many(
+            {"read": True, "expires_at": {"$exists": False}},
+            {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(days=NOTIFICATION_READ_RETENTION_DAYS)}}
+        )
+    except PyMongoError as e:
+        logger.error(f"Notification expiry backfill failed: {e}")
+
+# Long-running jobs started on startup and cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def start_background_jobs():
+    notification_dispatcher.start()
+    background_tasks.append(asyncio.create_task(reconcile_stats_periodically()))
+    background_tasks.append(asyncio.create_task(backfill_order_rollups()))
+    background_tasks.append(asyncio.create_task(compact_notifications_periodically()))
+    background_tasks.append(asyncio.create_task(migrate_quotation_files()))
+
+async def migrate_quotation_files():
+    # Cotizaciones antiguas con el archivo en base64 dentro del documento: pasarlo al blob store.
+    # En segundo plano y en orden de _id; mientras tanto (o si una falla) la descarga sigue usando file_data
+    query = {"file_data": {"$exists": True}}
+    last_id = None
+    migrated = 0
+    try:
+        while True:
+            batch_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+            quotations = await db.quotations.find(
+                batch_query, {"_id": 1, "file_data": 1, "content_type": 1}
+            ).sort("_id", ASCENDING).limit(QUOTATION_MIGRATION_BATCH_SIZE).to_list(QUOTATION_MIGRATION_BATCH_SIZE)
+            if not quotations:
+                break
+            last_id = quotations[-1]["_id"]
+            
+            for quotation in quotations:
+                try:
+                    content = base64.b64decode(quotation["file_data"] or "")
+                    stored = await blob_store.save(UploadFile(io.BytesIO(content)), len(content))
+                except (ValueError, TypeError, OSError, HTTPException) as e:
+                    logger.warning(f"Could not move quotation file {quotation['_id']} to the blob store: {e}")
+                    continue
+                await db.quotations.update_one(
+                    {"_id": quotation["_id"]},
+                    {
+                        "$set": {
+                            "blob_key": stored["blob_key"],
+                            "size": stored["size"],
+                            "content_type": quotation.get("content_type") or "application/pdf"
+                        },
+                        "$unset": {"file_data": ""}
+                    }
+                )
+                migrated += 1
+    except PyMongoError as e:
+        logger.error(f"Quotation file migration stopped after {migrated} files: {e}")
+        return
+    
+    if migrated:
+        logger.info(f"Moved {migrated} quotation files to the blob store")
+
+async def backfill_order_rollups():
+    # Primera vez con rollups: construirlos a partir del historial existente
+    try:
+        if not await db.order_rollups.find_one({}, {"_id": 1}) and await db.orders.find_one({}, {"_id": 1}):
+            processed = await rebuild_order_rollups()
+            logger.info(f"Built order rollups from {processed} orders")
+    except PyMongoError as e:
+        logger.error(f"Order rollup backfill failed: {e}")
+
 # Initialize admin user on startup
 @app.on_event("startup")
 async def create_default_admin():
@@ -40,17 +467,18 @@ async def create_default_admin():
     existing_admin = await db.users.find_one({"email": admin_email}, {"_id": 0})
     
     if not existing_admin:
-        admin_id = str(uuid.uuid4())
+        admin_id = new_id()
         admin_user = {
             "id": admin_id,
             "email": admin_email,
-            "password_hash": hash_password("admin123"),
+            "password_hash": await hash_password("admin123"),
             "name": "Administrador",
             "role": "admin",
             "company": "Mar de Cortez",
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
         await db.users.insert_one(admin_user)
+        await record_user_change("admin", 1)
         logger.info(f"Admin user created: {admin_email} / admin123")
 
 # Models
@@ -65,6 +493,36 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+def as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def parse_timestamp(value: str) -> datetime:
+    return as_utc(datetime.fromisoformat(value))
+
+# Ids UUIDv7: ordenados por tiempo de creación
+_uuid7_ms = 0
+_uuid7_seq = 0
+
+def new_id() -> str:
+    # UUIDv7: milisegundos Unix, contador y bits aleatorios; ordena por momento de creación
+    global _uuid7_ms, _uuid7_seq
+    ms = time.time_ns() // 1_000_000
+    if ms > _uuid7_ms:
+        _uuid7_ms, _uuid7_seq = ms, secrets.randbits(11)
+    else:
+        _uuid7_seq += 1
+        if _uuid7_seq > 0xFFF:
+            _uuid7_ms, _uuid7_seq = _uuid7_ms + 1, 0
+    value = (_uuid7_ms << 80) | (0x7 << 76) | (_uuid7_seq << 64) | (0b10 << 62) | secrets.randbits(62)
+    return str(uuid.UUID(int=value))
+
+def id_timestamp(value: str) -> datetime:
+    # Momento de creación embebido en un id de new_id()
+    return datetime.fromtimestamp((uuid.UUID(value).int >> 80) / 1000, timezone.utc)
+
+# Fechas guardadas como BSON date y enviadas al cliente como texto ISO-8601
+Timestamp = Annotated[datetime, AfterValidator(as_utc), PlainSerializer(lambda value: value.isoformat(), return_type=str)]
+
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -88,7 +546,8 @@ class Product(BaseModel):
     supplier_name: str
     sku: str
     image_url: Optional[str] = None
-    created_at: str
+    created_at: Timestamp
+    updated_at: Optional[Timestamp] = None
 
 class ProductCreate(BaseModel):
     name: str
@@ -101,6 +560,15 @@ class ProductCreate(BaseModel):
     sku: str
     image_url: Optional[str] = None
 
+class ProductReprice(BaseModel):
+    # Filtro: sin supplier_id ni category se recalcula todo el catálogo
+    supplier_id: Optional[str] = None
+    category: Optional[str] = None
+    # Nuevos valores opcionales, p. ej. cambio de IVA o del margen de un proveedor
+    iva_percentage: Optional[float] = None
+    profit_type: Optional[str] = None
+    profit_value: Optional[float] = None
+
 class OrderProduct(BaseModel):
     product_id: Optional[str] = None  # None for custom products
     product_name: str
@@ -110,6 +578,7 @@ class OrderProduct(BaseModel):
     image_url: Optional[str] = None  # For custom products
     is_custom: bool = False
     supplier_id: Optional[str] = None  # Referencia al proveedor del producto
+    category: Optional[str] = None  # Categoría del producto al crear la orden (para analítica)
 
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -125,10 +594,13 @@ class Order(BaseModel):
     assigned_to: Optional[str] = None
     notes: Optional[str] = None
     cancellation_reason: Optional[str] = None  # Motivo de cancelación
-    created_at: str
-    updated_at: str
+    created_at: Timestamp
+    updated_at: Timestamp
     requested_by: Optional[str] = None  # Usuario que creó la orden
     price_confirmed: bool = False  # Indica si el proveedor ya confirmó los precios
+    supplier_ids: List[str] = Field(default_factory=list)  # Proveedores con productos de catálogo en la orden
+    has_custom: bool = False  # La orden incluye productos personalizados
+    version: int = 0  # Se incrementa en cada cambio (concurrencia optimista)
 
 class OrderCreate(BaseModel):
     products: List[OrderProduct]
@@ -137,11 +609,13 @@ class OrderCreate(BaseModel):
 class OrderStatusUpdate(BaseModel):
     status: str
     assigned_to: Optional[str] = None
+    expected_version: Optional[int] = None  # Si se envía, 409 cuando la orden cambió
 
 class OrderTakeAndUpdate(BaseModel):
     status: str
     assigned_to: Optional[str] = None
     product_prices: Optional[dict] = None  # {product_index: price}
+    expected_version: Optional[int] = None  # Si se envía, 409 cuando la orden cambió
 
 class Quotation(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -149,11 +623,12 @@ class Quotation(BaseModel):
     order_id: str
     supplier_id: str
     supplier_name: str
-    file_data: str  # base64 encoded PDF
     file_name: str
+    content_type: Optional[str] = None
+    size: Optional[int] = None  # Bytes; el archivo se descarga de /quotations/{id}/file
     amount: Optional[float] = None
     notes: Optional[str] = None
-    created_at: str
+    created_at: Timestamp
 
 class QuotationCreate(BaseModel):
     amount: Optional[float] = None
@@ -165,7 +640,9 @@ class Notification(BaseModel):
     user_id: str
     message: str
     read: bool
-    created_at: str
+    order_id: Optional[str] = None
+    created_at: Timestamp
+    updated_at: Optional[Timestamp] = None
 
 class RegistrationRequest(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -175,9 +652,9 @@ class RegistrationRequest(BaseModel):
     phone: str
     email: EmailStr
     status: str  # 'pendiente', 'aprobado', 'rechazado'
-    created_at: str
+    created_at: Timestamp
     processed_by: Optional[str] = None
-    processed_at: Optional[str] = None
+    processed_at: Optional[Timestamp] = None
 
 class RegistrationRequestCreate(BaseModel):
     boat_name: str
@@ -191,7 +668,8 @@ class Category(BaseModel):
     name: str
     slug: str
     description: Optional[str] = None
-    created_at: str
+    created_at: Timestamp
+    updated_at: Optional[Timestamp] = None
 
 class CategoryCreate(BaseModel):
     name: str
@@ -211,13 +689,142 @@ class UserUpdate(BaseModel):
     name: Optional[str] = None
     company: Optional[str] = None
 
+class NotificationsMarkRead(BaseModel):
+    ids: Optional[List[str]] = None  # None marca todas como leídas
+
 # Helper Functions
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+class BcryptPool:
+    # Pool acotado para bcrypt fuera del event loop; mide cola y esperas para /admin/metrics
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.in_flight = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.in_flight - self.max_workers)
+
+    async def run(self, func, *args):
+        submitted_at = time.monotonic()
+
+        def timed_call():
+            wait = time.monotonic() - submitted_at
+            return wait, func(*args)
+
+        self.in_flight += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        try:
+            wait, result = await asyncio.get_running_loop().run_in_executor(self._executor, timed_call)
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        self.total_wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "completed": self.completed,
+            "avg_wait_ms": round(self.total_wait_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2)
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+bcrypt_pool = BcryptPool(BCRYPT_MAX_WORKERS)
+
+def _hash_password_sync(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
-def verify_password(password: str, hashed: str) -> bool:
+def _verify_password_sync(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+async def hash_password(password: str) -> str:
+    return await bcrypt_pool.run(_hash_password_sync, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await bcrypt_pool.run(_verify_password_sync, password, hashed)
+
+def password_needs_rehash(hashed: str) -> bool:
+    # bcrypt hashes look like $2b$<cost>$<salt+hash>
+    try:
+        return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+class TTLCache:
+    # LRU en memoria con expiración por entrada; generation evita guardar lo leído antes de un invalidate
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, generation: Optional[int] = None):
+        if self.max_entries <= 0 or self.ttl_seconds <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key=None):
+        self.generation += 1
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+user_cache = TTLCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+supplier_products_cache = TTLCache(SUPPLIER_PRODUCTS_CACHE_MAX_ENTRIES, SUPPLIER_PRODUCTS_CACHE_TTL_SECONDS)
+# Keyed by ETag, so a write (new collection version) is a miss here too
+category_cache = TTLCache(CATEGORY_CACHE_MAX_ENTRIES, CATEGORY_CACHE_TTL_SECONDS)
+collection_version_cache = TTLCache(16, COLLECTION_VERSION_CACHE_SECONDS)
+category_list_adapter = TypeAdapter(List[Category])
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -225,18 +832,28 @@ def create_access_token(data: dict) -> str:
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
+    return await user_from_token(credentials.credentials)
+
+async def user_from_token(token: str, scope: Optional[str] = None) -> User:
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
-        if user_id is None:
+        # Un token de alcance limitado (p.ej. "events") no sirve como sesión, ni al revés
+        if user_id is None or payload.get("scope") != scope:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+        cached_user = user_cache.get(user_id)
+        if cached_user is not None:
+            return cached_user
+        
+        generation = user_cache.generation
+        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
         if not user_doc:
             raise HTTPException(status_code=401, detail="User not found")
         
-        return User(**user_doc)
+        user = User(**user_doc)
+        user_cache.set(user_id, user, generation=generation)
+        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except Exception as e:
@@ -247,15 +864,1056 @@ async def get_admin_user(current_user: User = Depends(get_current_user)) -> User
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
-async def create_notification(user_id: str, message: str):
+class EventHub:
+    # Pub/sub en memoria hacia los /events de este worker; quien se atrasa recibe un resync
+
+    def __init__(self, max_queued: int):
+        self.max_queued = max_queued
+        self.published = 0
+        self.resyncs = 0
+        self._subscribers = {}
+
+    def subscribe(self, user: User):
+        subscription_id = uuid.uuid4().hex
+        queue = asyncio.Queue(maxsize=self.max_queued)
+        self._subscribers[subscription_id] = (user.id, user.role, queue)
+        return subscription_id, queue
+
+    def unsubscribe(self, subscription_id: str):
+        self._subscribers.pop(subscription_id, None)
+
+    def publish(self, event_type: str, data: dict, user_ids=(), roles=()):
+        self.published += 1
+        event = {"type": event_type, "data": data}
+        for user_id, role, queue in self._subscribers.values():
+            if user_id not in user_ids and role not in roles:
+                continue
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync", "data": {}})
+                self.resyncs += 1
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self._subscribers), "published": self.published, "resyncs": self.resyncs}
+
+event_hub = EventHub(SSE_QUEUE_MAX)
+
+def order_audience(order: dict):
+    # (user_ids, roles) que ven la orden además de admin; espejo de order_scope_query
+    user_ids = [uid for uid in [order["client_id"], order.get("supplier_id"), order.get("assigned_to"), *order.get("supplier_ids", [])] if uid]
+    roles = ["proveedor"] if order.get("has_custom") else None
+    return user_ids, roles
+
+def publish_quotation_event(order: dict, quotation: dict):
+    # Mismos lectores que get_quotations: el cliente, el proveedor asignado y admin
+    user_ids = [uid for uid in (order["client_id"], order.get("supplier_id")) if uid]
+    event_hub.publish("quotation.created", quotation, user_ids, ["admin"])
+
+def publish_order_event(event_type: str, order: dict, data: Optional[dict] = None):
+    user_ids, roles = order_audience(order)
+    event_hub.publish(event_type, data if data is not None else Order(**order).model_dump(), user_ids, ["admin", *(roles or [])])
+
+async def record_unread_changes(increments: dict):
+    # Aplicar deltas por usuario a los contadores de no leídas
+    operations = [
+        UpdateOne({"_id": user_id}, {"$inc": {"unread": delta}}, upsert=True)
+        for user_id, delta in increments.items() if delta
+    ]
+    if not operations:
+        return
+    try:
+        await db.notification_counters.bulk_write(operations, ordered=False)
+    except PyMongoError as e:
+        # reconcile_unread_counts corrige la diferencia en la próxima pasada
+        logger.error(f"Unread counter update failed: {e}")
+
+async def reconcile_unread_counts() -> int:
+    # Recontar no leídas por usuario y sobrescribir los contadores
+    counts = await db.notifications.aggregate([
+        {"$match": {"read": False}},
+        {"$group": {"_id": "$user_id", "unread": {"$sum": 1}}}
+    ]).to_list(None)
+    operations = [UpdateOne({"_id": row["_id"]}, {"$set": {"unread": row["unread"]}}, upsert=True) for row in counts]
+    if operations:
+        await db.notification_counters.bulk_write(operations, ordered=False)
+    await db.notification_counters.update_many(
+        {"_id": {"$nin": [row["_id"] for row in counts]}, "unread": {"$ne": 0}},
+        {"$set": {"unread": 0}}
+    )
+    return len(counts)
+
+def notification_read_update() -> dict:
+    # Al marcarse como leída empieza a contar la retención (ver purge_expired_notifications)
+    now = datetime.now(timezone.utc)
+    return {"$set": {
+        "read": True,
+        "updated_at": now,
+        "expires_at": now + timedelta(days=NOTIFICATION_READ_RETENTION_DAYS)
+    }}
+
+async def delete_notifications(notifications: list) -> int:
+    # Tombstones antes del borrado: si este falla, la próxima pasada lo repite
+    await db.tombstones.insert_many([
+        tombstone_doc("notifications", n["id"], user_ids=[n["user_id"]]) for n in notifications
+    ], ordered=False)
+    result = await db.notifications.delete_many({"_id": {"$in": [n["_id"] for n in notifications]}})
+    return result.deleted_count
+
+async def compact_notifications() -> int:
+    # Dejar a cada usuario sus NOTIFICATION_MAX_PER_USER notificaciones más recientes
+    removed = 0
+    crowded = await db.notifications.aggregate([
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": NOTIFICATION_MAX_PER_USER}}}
+    ]).to_list(None)
+    for user in crowded:
+        # Por lotes: lo que sobra tras las más recientes, hasta que no quede nada
+        while True:
+            overflow = await db.notifications.find(
+                {"user_id": user["_id"]}, {"_id": 1, "id": 1, "user_id": 1, "read": 1}
+            ).sort([("created_at", DESCENDING), ("id", DESCENDING)]).skip(NOTIFICATION_MAX_PER_USER).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+            if not overflow:
+                break
+            removed += await delete_notifications(overflow)
+            unread = sum(1 for n in overflow if not n["read"])
+            if unread:
+                await record_unread_changes({user["_id"]: -unread})
+    return removed
+
+async def purge_expired_notifications() -> int:
+    # Borrado programado en vez de índice TTL: así /sync recibe los tombstones
+    now = datetime.now(timezone.utc)
+    removed = 0
+    while True:
+        expired = await db.notifications.find(
+            {"expires_at": {"$lte": now}}, {"_id": 1, "id": 1, "user_id": 1}
+        ).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not expired:
+            return removed
+        removed += await delete_notifications(expired)
+
+async def compact_notifications_periodically():
+    while True:
+        try:
+            expired = await purge_expired_notifications()
+            if expired:
+                logger.info(f"Removed {expired} expired read notifications")
+            removed = await compact_notifications()
+            if removed:
+                logger.info(f"Removed {removed} notifications over the per-user cap")
+        except PyMongoError as e:
+            logger.error(f"Notification compaction failed: {e}")
+        await asyncio.sleep(NOTIFICATION_COMPACT_INTERVAL_SECONDS)
+
+class NotificationDispatcher:
+    # Escribe notificaciones por lotes desde un worker, fusionando las de igual clave
+
+    def __init__(self, batch_size: int, window_seconds: float, max_queued: int):
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self.max_queued = max_queued
+        self.inserted = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.failed = 0
+        self._queue = None
+        self._worker = None
+        self._stopping = False
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._stopping = False
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._stopping = True
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+
+    async def publish(self, notification: dict, coalesce_key=None):
+        if self._worker is None or self._stopping or self._worker.done():
+            await self._write([notification])
+            return
+        try:
+            self._queue.put_nowait((coalesce_key, notification))
+        except asyncio.QueueFull:
+            await self._write([notification])
+
+    async def _run(self):
+        done = False
+        while not done:
+            batch, done = await self._collect()
+            await self._write(batch)
+
+    async def _collect(self):
+        pending = OrderedDict()
+        loop = asyncio.get_running_loop()
+        deadline = None
+        while len(pending) < self.batch_size:
+            if deadline is None:
+                item = await self._queue.get()
+                deadline = loop.time() + self.window_seconds
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                return list(pending.values()), True
+            coalesce_key, notification = item
+            key = coalesce_key if coalesce_key is not None else object()
+            if pending.pop(key, None) is not None:
+                self.coalesced += 1
+            pending[key] = notification
+        return list(pending.values()), False
+
+    async def _write(self, batch: list):
+        if not batch:
+            return
+        # Id y fechas al escribir, no al encolar: /sync solo tolera SYNC_CLOCK_SKEW_SECONDS de retraso
+        for notification in batch:
+            notification["id"] = new_id()
+            notification["created_at"] = notification["updated_at"] = id_timestamp(notification["id"])
+        try:
+            await db.notifications.insert_many(batch, ordered=False)
+            stored = batch
+        except BulkWriteError as e:
+            rejected = {write_error["index"] for write_error in e.details.get("writeErrors", [])}
+            stored = [notification for index, notification in enumerate(batch) if index not in rejected]
+            self.failed += len(rejected)
+            logger.error(f"Failed to store {len(rejected)} of {len(batch)} notifications: {e}")
+        except PyMongoError as e:
+            self.failed += len(batch)
+            logger.error(f"Failed to store {len(batch)} notifications: {e}")
+            return
+        self.inserted += len(stored)
+        self.batches += 1
+        await record_unread_changes(Counter(notification["user_id"] for notification in stored))
+        # Avisar solo de lo que quedó guardado (las fusionadas nunca se escriben)
+        for notification in stored:
+            event = {key: value for key, value in notification.items() if key != "_id"}
+            event_hub.publish("notification.created", event, [notification["user_id"]])
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "inserted": self.inserted,
+            "coalesced": self.coalesced,
+            "batches": self.batches,
+            "failed": self.failed
+        }
+
+notification_dispatcher = NotificationDispatcher(
+    NOTIFICATION_BATCH_SIZE, NOTIFICATION_BATCH_WINDOW_SECONDS, NOTIFICATION_QUEUE_MAX
+)
+
+async def create_notification(user_id: str, message: str, order_id: Optional[str] = None, kind: Optional[str] = None):
+    # Con kind, una más nueva del mismo usuario/orden/tipo reemplaza a la que sigue en cola
     notification = {
-        "id": str(uuid.uuid4()),
         "user_id": user_id,
         "message": message,
         "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "order_id": order_id
+    }
+    coalesce_key = (user_id, order_id, kind) if kind else None
+    await notification_dispatcher.publish(notification, coalesce_key)
+
+def order_supplier_fields(products: list) -> dict:
+    return {
+        "supplier_ids": sorted({p["supplier_id"] for p in products if p.get("supplier_id")}),
+        "has_custom": any(p.get("is_custom") for p in products)
+    }
+
+async def get_supplier_product_ids(supplier_id: str) -> frozenset:
+    cached = supplier_products_cache.get(supplier_id)
+    if cached is not None:
+        return cached
+    
+    generation = supplier_products_cache.generation
+    products = await db.products.find({"supplier_id": supplier_id}, {"_id": 0, "id": 1}).to_list(None)
+    product_ids = frozenset(p["id"] for p in products)
+    supplier_products_cache.set(supplier_id, product_ids, generation=generation)
+    return product_ids
+
+async def supplier_can_access_order(order: dict, supplier_id: str) -> bool:
+    # Pedidos con productos de su catálogo, o personalizados (cualquier proveedor puede cotizar)
+    if "supplier_ids" in order:
+        return supplier_id in order["supplier_ids"] or order.get("has_custom", False)
+    
+    # Orden aún sin supplier_ids (backfill pendiente): comparar contra el catálogo en caché
+    product_ids = await get_supplier_product_ids(supplier_id)
+    return any(
+        line.get("is_custom") or line.get("product_id") in product_ids
+        for line in order.get("products", [])
+    )
+
+def order_version_filter(version: int) -> dict:
+    # Órdenes anteriores al campo version cuentan como versión 0
+    if version == 0:
+        return {"version": {"$in": [0, None]}}
+    return {"version": version}
+
+def order_conflict() -> HTTPException:
+    return HTTPException(status_code=409, detail="La orden fue modificada por otro usuario; recárgala e intenta de nuevo")
+
+def apply_order_update(before: dict, update_data: dict) -> dict:
+    # Estado posterior a {"$set": update_data, "$inc": {"version": 1}}, sin releer la orden
+    return {**before, **update_data, "version": before.get("version", 0) + 1}
+
+# Admin stats: counters kept in a single admin_stats document, adjusted by every write path
+def stats_field(value) -> str:
+    # Los valores (rol, estado) forman parte del nombre del campo
+    return str(value).replace('.', '_').replace('$', '_')
+
+def stats_key(prefix: str, value) -> str:
+    return f"{prefix}.{stats_field(value)}"
+
+async def bump_stats(increments: dict):
+    increments = {key: value for key, value in increments.items() if value}
+    if increments:
+        await db.admin_stats.update_one({"_id": "global"}, {"$inc": increments}, upsert=True)
+
+async def record_user_change(role: str, delta: int):
+    await bump_stats({"users_total": delta, stats_key("users_by_role", role): delta})
+
+# Order rollups: one document per day x supplier x category x status.
+# Each order also counts once under category "*" so totals across categories are not double counted.
+ROLLUP_ALL_CATEGORIES = "*"
+ROLLUP_REPAIR_PASSES = 5
+
+def order_rollup_buckets(order: dict) -> dict:
+    day = str(order["created_at"])[:10]
+    supplier_id = order.get("supplier_id") or "sin_asignar"
+    status = order["status"]
+    buckets = {
+        (day, supplier_id, ROLLUP_ALL_CATEGORIES, status): {
+            "orders": 1,
+            "revenue": order.get("total") or 0,
+            "items": sum(line.get("quantity", 0) for line in order.get("products", []))
+        }
+    }
+    for line in order.get("products", []):
+        category = "personalizado" if line.get("is_custom") else (line.get("category") or "sin_categoria")
+        bucket = buckets.setdefault((day, supplier_id, category, status), {"orders": 1, "revenue": 0, "items": 0})
+        bucket["revenue"] += (line.get("price") or 0) * line.get("quantity", 0)
+        bucket["items"] += line.get("quantity", 0)
+    return buckets
+
+async def record_order_rollups(before: Optional[dict], after: Optional[dict]):
+    increments = {}
+    for order, sign in ((before, -1), (after, 1)):
+        if not order:
+            continue
+        for key, values in order_rollup_buckets(order).items():
+            totals = increments.setdefault(key, {"orders": 0, "revenue": 0, "items": 0})
+            for field, value in values.items():
+                totals[field] += sign * value
+    
+    operations = []
+    for (day, supplier_id, category, status), totals in increments.items():
+        totals = {field: value for field, value in totals.items() if value}
+        if totals:
+            operations.append(UpdateOne(
+                {"day": day, "supplier_id": supplier_id, "category": category, "status": status},
+                {"$inc": totals},
+                upsert=True
+            ))
+    if operations:
+        await db.order_rollups.bulk_write(operations, ordered=False)
+
+async def compute_order_rollups(query: dict) -> tuple:
+    totals = {}
+    processed = 0
+    backfill = []
+    projection = {"_id": 1, "created_at": 1, "supplier_id": 1, "status": 1, "total": 1, "products": 1}
+    async for order in db.orders.find(query, projection).batch_size(MIGRATION_BATCH_SIZE):
+        # Órdenes antiguas sin categoría en las líneas: tomarla del catálogo y guardarla en la orden,
+        # así record_order_change resta después del mismo bucket que sumamos aquí
+        missing = [line["product_id"] for line in order.get("products", []) if line.get("product_id") and not line.get("category")]
+        if missing:
+            found = await db.products.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "category": 1}).to_list(len(missing))
+            categories = {p["id"]: p.get("category") for p in found}
+            resolved = {}
+            for index, line in enumerate(order["products"]):
+                if not line.get("category"):
+                    line["category"] = categories.get(line.get("product_id"))
+                    if line["category"]:
+                        resolved[f"products.{index}.category"] = line["category"]
+            if resolved:
+                backfill.append(UpdateOne({"_id": order["_id"]}, {"$set": resolved}))
+            if len(backfill) >= MIGRATION_BATCH_SIZE:
+                await db.orders.bulk_write(backfill, ordered=False)
+                backfill = []
+        
+        for key, values in order_rollup_buckets(order).items():
+            bucket = totals.setdefault(key, {"orders": 0, "revenue": 0, "items": 0})
+            for field, value in values.items():
+                bucket[field] += value
+        processed += 1
+    if backfill:
+        await db.orders.bulk_write(backfill, ordered=False)
+    return totals, processed
+
+async def rebuild_order_rollups() -> int:
+    # Se construye aparte y se reemplaza de una vez; los días que cambiaron durante el recorrido se rehacen después
+    started = datetime.now(timezone.utc)
+    totals, processed = await compute_order_rollups({})
+    
+    staging = db[f"order_rollups_rebuild_{uuid.uuid4().hex[:8]}"]
+    await staging.create_indexes(REQUIRED_INDEXES["order_rollups"])
+    rows = [
+        {"day": day, "supplier_id": supplier_id, "category": category, "status": status, **values}
+        for (day, supplier_id, category, status), values in totals.items()
+    ]
+    for start in range(0, len(rows), MIGRATION_BATCH_SIZE):
+        await staging.insert_many(rows[start:start + MIGRATION_BATCH_SIZE], ordered=False)
+    await staging.rename("order_rollups", dropTarget=True)
+    
+    await repair_order_rollups(started)
+    return processed
+
+async def changed_order_days(since: datetime) -> set:
+    # Días (de created_at) con órdenes creadas, modificadas o borradas desde since
+    since = since - timedelta(seconds=SYNC_CLOCK_SKEW_SECONDS)
+    days = set()
+    async for order in db.orders.find({"updated_at": {"$gte": since}}, {"_id": 0, "created_at": 1}):
+        days.add(str(order["created_at"])[:10])
+    # Borradas: el día sale del id (UUIDv7); las de ids antiguos no se pueden ubicar
+    async for tombstone in db.tombstones.find({"collection": "orders", "deleted_at": {"$gte": since}}, {"_id": 0, "id": 1}):
+        try:
+            if uuid.UUID(tombstone["id"]).version == 7:
+                days.add(str(id_timestamp(tombstone["id"]))[:10])
+        except ValueError:
+            continue
+    return days
+
+async def repair_order_rollups(since: datetime):
+    # Los $inc que cayeron en la colección reemplazada se pierden: recalcular esos días con $set.
+    # Se repite mientras sigan llegando cambios, hasta ROLLUP_REPAIR_PASSES vueltas
+    for _ in range(ROLLUP_REPAIR_PASSES):
+        pass_started = datetime.now(timezone.utc)
+        days = await changed_order_days(since)
+        if not days:
+            return
+        for day in days:
+            start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+            totals, _ = await compute_order_rollups({"created_at": {"$gte": start, "$lt": start + timedelta(days=1)}})
+            operations = [
+                UpdateOne(
+                    {"day": day, "supplier_id": supplier_id, "category": category, "status": status},
+                    {"$set": values},
+                    upsert=True
+                )
+                for (_, supplier_id, category, status), values in totals.items()
+            ]
+            if operations:
+                await db.order_rollups.bulk_write(operations, ordered=False)
+            existing = await db.order_rollups.find({"day": day}, {"_id": 1, "supplier_id": 1, "category": 1, "status": 1}).to_list(None)
+            stale = [row["_id"] for row in existing if (day, row["supplier_id"], row["category"], row["status"]) not in totals]
+            if stale:
+                await db.order_rollups.delete_many({"_id": {"$in": stale}})
+        since = pass_started
+    logger.warning(f"Order rollups still changing after {ROLLUP_REPAIR_PASSES} repair passes; run the rebuild again later")
+
+async def record_order_change(before: Optional[dict], after: Optional[dict]):
+    await record_order_rollups(before, after)
+    increments = {}
+    for order, sign in ((before, -1), (after, 1)):
+        if not order:
+            continue
+        status_key = stats_key("orders_by_status", order["status"])
+        revenue_key = stats_key("revenue_by_status", order["status"])
+        increments["orders_total"] = increments.get("orders_total", 0) + sign
+        increments[status_key] = increments.get(status_key, 0) + sign
+        increments[revenue_key] = increments.get(revenue_key, 0) + sign * (order.get("total") or 0)
+    await bump_stats(increments)
+
+async def reconcile_stats() -> dict:
+    # Recalcular los contadores con $group y sobrescribir el documento de stats
+    users = await db.users.aggregate([{"$group": {"_id": "$role", "count": {"$sum": 1}}}]).to_list(None)
+    orders = await db.orders.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}, "revenue": {"$sum": "$total"}}}
+    ]).to_list(None)
+    requests = await db.registration_requests.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    
+    doc = {
+        "users_total": sum(row["count"] for row in users),
+        "products_total": await db.products.count_documents({}),
+        "orders_total": sum(row["count"] for row in orders),
+        "users_by_role": {},
+        "orders_by_status": {},
+        "revenue_by_status": {},
+        "registration_requests_by_status": {},
+        "reconciled_at": datetime.now(timezone.utc)
     }
-    await db.notifications.insert_one(notification)
+    for row in users:
+        doc["users_by_role"][stats_field(row["_id"])] = row["count"]
+    for row in orders:
+        doc["orders_by_status"][stats_field(row["_id"])] = row["count"]
+        doc["revenue_by_status"][stats_field(row["_id"])] = row["revenue"]
+    for row in requests:
+        doc["registration_requests_by_status"][stats_field(row["_id"])] = row["count"]
+    
+    await db.admin_stats.replace_one({"_id": "global"}, doc, upsert=True)
+    return doc
+
+async def reconcile_stats_periodically():
+    while True:
+        try:
+            await reconcile_stats()
+        except PyMongoError as e:
+            logger.error(f"Stats reconciliation failed: {e}")
+        try:
+            await reconcile_unread_counts()
+        except PyMongoError as e:
+            logger.error(f"Unread counter reconciliation failed: {e}")
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL_SECONDS)
+
+# Streaming exports: column layout per entity; orders produce one row per line item
+ORDER_EXPORT_COLUMNS = [
+    "id", "order_number", "client_id", "client_name", "supplier_id", "supplier_name", "status", "total",
+    "assigned_to", "requested_by", "price_confirmed", "notes", "cancellation_reason", "created_at", "updated_at"
+]
+ORDER_LINE_EXPORT_COLUMNS = [
+    "line_index", "product_id", "product_name", "quantity", "price", "is_custom", "line_supplier_id", "category", "description"
+]
+EXPORTS = {
+    "orders": {
+        "collection": "orders",
+        "columns": ORDER_EXPORT_COLUMNS + ORDER_LINE_EXPORT_COLUMNS
+    },
+    "products": {
+        "collection": "products",
+        "columns": [
+            "id", "sku", "name", "description", "category", "price", "base_price", "profit_type", "profit_value",
+            "iva_percentage", "supplier_id", "supplier_name", "image_url", "created_at"
+        ]
+    },
+    "users": {
+        "collection": "users",
+        "columns": ["id", "email", "name", "role", "company", "created_at"]
+    },
+}
+
+def export_rows(entity: str, doc: dict):
+    if entity != "orders":
+        yield {column: doc.get(column) for column in EXPORTS[entity]["columns"]}
+        return
+    
+    order = {column: doc.get(column) for column in ORDER_EXPORT_COLUMNS}
+    lines = doc.get("products") or [{}]
+    for index, line in enumerate(lines):
+        yield {
+            **order,
+            "line_index": index if line else None,
+            "product_id": line.get("product_id"),
+            "product_name": line.get("product_name"),
+            "quantity": line.get("quantity"),
+            "price": line.get("price"),
+            "is_custom": line.get("is_custom"),
+            "line_supplier_id": line.get("supplier_id"),
+            "category": line.get("category"),
+            "description": line.get("description")
+        }
+
+async def stream_export(entity: str, export_format: str):
+    columns = EXPORTS[entity]["columns"]
+    projection = {"_id": 0, **{column: 1 for column in columns}}
+    if entity == "orders":
+        projection = {"_id": 0, "products": 1, **{column: 1 for column in ORDER_EXPORT_COLUMNS}}
+    cursor = db[EXPORTS[entity]["collection"]].find({}, projection).sort(
+        [("created_at", ASCENDING), ("id", ASCENDING)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+    
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    if export_format == "csv":
+        writer.writeheader()
+    
+    async for doc in cursor:
+        for row in export_rows(entity, doc):
+            row = {column: value.isoformat() if isinstance(value, datetime) else value for column, value in row.items()}
+            if export_format == "csv":
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(row, ensure_ascii=False, default=json_default))
+                buffer.write("\n")
+        # Enviar por bloques para no acumular la exportación completa en memoria
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def keyset_query(query: dict, sort_field: str, value, last_id: str, direction: int = ASCENDING) -> dict:
+    # Documentos estrictamente posteriores a (value, last_id) en el orden (sort_field, id)
+    op = "$lt" if direction == DESCENDING else "$gt"
+    keyset = {"$or": [{sort_field: {op: value}}, {sort_field: value, "id": {op: last_id}}]}
+    return {"$and": [query, keyset]} if query else keyset
+
+def order_scope_query(user: User) -> dict:
+    if user.role == "cliente":
+        return {"client_id": user.id}
+    if user.role == "proveedor":
+        # Proveedores ven:
+        # 1. Órdenes asignadas directamente a ellos
+        # 2. Órdenes con productos de su catálogo
+        # 3. Órdenes con productos personalizados (para que puedan cotizar)
+        return {"$or": [
+            {"supplier_id": user.id},
+            {"assigned_to": user.id},
+            {"supplier_ids": user.id},
+            {"has_custom": True}
+        ]}
+    # Admin ve todas las órdenes
+    return {}
+
+def tombstone_doc(collection: str, doc_id: str, user_ids: Optional[list] = None, roles: Optional[list] = None) -> dict:
+    # Registro de un borrado para /sync; user_ids y roles en None = todos
+    now = datetime.now(timezone.utc)
+    return {
+        "id": doc_id,
+        "collection": collection,
+        "user_ids": user_ids,
+        "roles": roles,
+        "deleted_at": now,
+        "expires_at": now + timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    }
+
+async def record_tombstone(collection: str, doc_id: str, user_ids: Optional[list] = None, roles: Optional[list] = None):
+    await db.tombstones.insert_one(tombstone_doc(collection, doc_id, user_ids, roles))
+
+async def bump_collection_version(collection: str):
+    # Cada escritura cambia la versión y con ella el ETag de los listados
+    await db.collection_versions.update_one(
+        {"_id": collection},
+        {
+            "$inc": {"version": 1},
+            "$set": {"updated_at": datetime.now(timezone.utc)},
+            "$setOnInsert": {"epoch": uuid.uuid4().hex}
+        },
+        upsert=True
+    )
+    collection_version_cache.invalidate(collection)
+
+async def get_collection_version(collection: str, cached: bool = False) -> dict:
+    if cached:
+        version = collection_version_cache.get(collection)
+        if version is not None:
+            return version
+        generation = collection_version_cache.generation
+    version = await db.collection_versions.find_one({"_id": collection})
+    if version is None:
+        await db.collection_versions.update_one(
+            {"_id": collection},
+            {"$setOnInsert": {"version": 0, "epoch": uuid.uuid4().hex, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        version = await db.collection_versions.find_one({"_id": collection})
+    if cached:
+        collection_version_cache.set(collection, version, generation=generation)
+    return version
+
+async def check_not_modified(
+    collection: str,
+    variant: tuple,
+    if_none_match: Optional[str],
+    response: Response,
+    cache_control: str,
+    cached_version: bool = False
+) -> Optional[Response]:
+    # 304 si la copia del cliente sigue vigente; si no, fija ETag/Last-Modified y devuelve None
+    version = await get_collection_version(collection, cached=cached_version)
+    digest = hashlib.sha1(json.dumps(variant, separators=(",", ":")).encode('utf-8')).hexdigest()[:16]
+    etag = f'"{collection}-{version["epoch"][:8]}-{version["version"]}-{digest}"'
+    
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Authorization"}
+    updated_at = version["updated_at"]
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    headers["Last-Modified"] = updated_at.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    
+    if if_none_match:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in candidates or etag in candidates or f"W/{etag}" in candidates:
+            return Response(status_code=304, headers=headers)
+    
+    response.headers.update(headers)
+    return None
+
+def encode_sort_value(value):
+    # Las fechas viajan etiquetadas para volver a compararse como fechas
+    return {"$date": value.isoformat()} if isinstance(value, datetime) else value
+
+def decode_sort_value(value):
+    if isinstance(value, dict):
+        return parse_timestamp(value["$date"])
+    return value
+
+def json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+def encode_sync_token(watermarks: dict) -> str:
+    encoded = {name: [encode_sort_value(value), last_id] for name, (value, last_id) in watermarks.items()}
+    raw = json.dumps(encoded, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip("=")
+
+def decode_sync_token(token: str) -> dict:
+    try:
+        watermarks = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(watermarks, dict):
+            raise ValueError
+        watermarks = {name: [decode_sort_value(value), last_id] for name, (value, last_id) in watermarks.items()}
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    return watermarks
+
+def encode_cursor(doc: dict, sort_field: str) -> str:
+    raw = json.dumps([encode_sort_value(doc.get(sort_field)), doc["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip("=")
+
+def decode_cursor(token: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        value, last_id = json.loads(raw)
+        value = decode_sort_value(value)
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, last_id
+
+async def fetch_page(
+    collection,
+    query: dict,
+    response: Response,
+    limit: int,
+    after: Optional[str] = None,
+    sort_field: str = "created_at",
+    direction: int = DESCENDING,
+    projection: Optional[dict] = None
+) -> list:
+    # Paginación por (sort_field, id) desde el cursor after; X-Next-Cursor si quedan más
+    if after:
+        value, last_id = decode_cursor(after)
+        query = keyset_query(query, sort_field, value, last_id, direction)
+    
+    docs = await collection.find(query, projection or {"_id": 0}).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(docs[-1], sort_field)
+    return docs
+
+async def search_products(query: dict, q: str, limit: int) -> list:
+    # Primero coincidencias por prefijo de SKU, luego el índice de texto ordenado por textScore
+    results = []
+    seen = set()
+    
+    terms = q.split()
+    if len(terms) == 1:
+        prefixes = {terms[0], terms[0].upper()}
+        sku_query = {**query, "sku": {"$in": [re.compile("^" + re.escape(prefix)) for prefix in prefixes]}}
+        for product in await db.products.find(sku_query, {"_id": 0}).sort("sku", ASCENDING).limit(limit).to_list(limit):
+            results.append(product)
+            seen.add(product["id"])
+    
+    if len(results) < limit:
+        text_query = {**query, "$text": {"$search": q}}
+        ranked = await db.products.find(
+            text_query, {"_id": 0, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(limit)
+        for product in ranked:
+            if product["id"] not in seen and len(results) < limit:
+                results.append(product)
+    
+    return results
+
+def read_import_rows(upload: UploadFile, format: Optional[str]):
+    # (fila, dict o mensaje de error) de un CSV/JSONL, sin cargarlo entero
+    if format is None:
+        suffix = Path(upload.filename or "").suffix.lower()
+        format = "csv" if suffix == ".csv" else "jsonl" if suffix in (".jsonl", ".ndjson") else None
+    if format not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail="Formato no soportado: usa CSV o JSONL")
+    
+    # Decodificar línea a línea: un byte inválido estropea su fila, no la importación entera
+    undecodable = []
+    
+    def decoded_lines():
+        upload.file.seek(0)
+        for line_number, raw in enumerate(upload.file, start=1):
+            if line_number == 1:
+                raw = raw.removeprefix(b"\xef\xbb\xbf")
+            try:
+                yield raw.decode("utf-8")
+            except UnicodeDecodeError:
+                undecodable.append(line_number)
+                yield raw.decode("utf-8", errors="replace")
+    
+    if format == "csv":
+        reader = csv.DictReader(decoded_lines())
+        if reader.fieldnames is None or undecodable:
+            raise HTTPException(status_code=400, detail="El encabezado del CSV falta o no está en UTF-8")
+        # La fila 1 es el encabezado
+        for row_number, row in enumerate(reader, start=2):
+            if undecodable:
+                undecodable.clear()
+                yield row_number, "Fila no codificada en UTF-8"
+            else:
+                yield row_number, row
+    else:
+        for row_number, line in enumerate(decoded_lines(), start=1):
+            if undecodable:
+                undecodable.clear()
+                yield row_number, "Fila no codificada en UTF-8"
+                continue
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row_number, row if isinstance(row, dict) else "Fila JSON inválida"
+
+async def import_products(upload: UploadFile, format: Optional[str], supplier: dict) -> dict:
+    # Upsert por (supplier_id, sku) en lotes; si un SKU se repite gana la última fila
+    report = {"processed": 0, "created": 0, "updated": 0, "failed": 0, "errors": []}
+    
+    def add_error(row_number: int, sku: Optional[str], messages: list):
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_REPORTED_ERRORS:
+            report["errors"].append({"row": row_number, "sku": sku, "errors": messages})
+    
+    async def flush(batch: dict):
+        if not batch:
+            return
+        row_numbers = list(batch.keys())
+        rows = list(batch.values())
+        prices = calculate_prices(
+            [product_data.base_price for product_data in rows],
+            [product_data.profit_type for product_data in rows],
+            [product_data.profit_value for product_data in rows],
+            [product_data.iva_percentage for product_data in rows]
+        )
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"supplier_id": supplier["id"], "sku": product_data.sku},
+                {
+                    "$set": {
+                        "name": product_data.name,
+                        "description": product_data.description,
+                        "category": product_data.category,
+                        "base_price": product_data.base_price,
+                        "profit_type": product_data.profit_type,
+                        "profit_value": product_data.profit_value,
+                        "iva_percentage": product_data.iva_percentage,
+                        "price": price,
+                        "supplier_name": supplier["name"],
+                        "image_url": product_data.image_url,
+                        "updated_at": now
+                    },
+                    "$setOnInsert": {"id": new_id(), "created_at": now}
+                },
+                upsert=True
+            )
+            for product_data, price in zip(rows, prices)
+        ]
+        try:
+            result = await db.products.bulk_write(operations, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for write_error in details.get("writeErrors", []):
+                row_number = row_numbers[write_error["index"]]
+                add_error(row_number, batch[row_number].sku, [write_error.get("errmsg", "Error de escritura")])
+        created = details.get("nUpserted", 0)
+        report["created"] += created
+        report["updated"] += details.get("nMatched", 0)
+        if created:
+            await bump_stats({"products_total": created})
+    
+    batch = {}
+    batch_skus = {}
+    rows = read_import_rows(upload, format)
+    while True:
+        # El archivo subido puede estar en disco: leer cada tramo fuera del event loop
+        chunk = await asyncio.to_thread(list, itertools.islice(rows, IMPORT_BATCH_SIZE))
+        if not chunk:
+            break
+        for row_number, row in chunk:
+            report["processed"] += 1
+            if isinstance(row, str):
+                add_error(row_number, None, [row])
+                continue
+            # Celdas vacías del CSV toman el valor por defecto del modelo
+            row = {key: value for key, value in row.items() if key and value not in ("", None)}
+            try:
+                product_data = ProductCreate(**row)
+            except ValidationError as e:
+                add_error(row_number, row.get("sku"), [f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()])
+                continue
+            
+            previous = batch_skus.pop(product_data.sku, None)
+            if previous is not None:
+                del batch[previous]
+            batch[row_number] = product_data
+            batch_skus[product_data.sku] = row_number
+            
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await flush(batch)
+                batch, batch_skus = {}, {}
+    
+    await flush(batch)
+    
+    supplier_products_cache.invalidate(supplier["id"])
+    await bump_collection_version("products")
+    report["errors_truncated"] = report["failed"] > len(report["errors"])
+    return report
+
+# Quotation file storage
+class LocalBlobStore:
+    # Blobs en disco direccionados por SHA-256
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    async def save(self, upload: UploadFile, max_bytes: int) -> dict:
+        tmp_dir = self.root / "tmp"
+        await asyncio.to_thread(tmp_dir.mkdir, parents=True, exist_ok=True)
+        tmp_path = tmp_dir / uuid.uuid4().hex
+        digest = hashlib.sha256()
+        size = 0
+        handle = await asyncio.to_thread(open, tmp_path, "wb")
+        try:
+            while chunk := await upload.read(BLOB_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+                digest.update(chunk)
+                await asyncio.to_thread(handle.write, chunk)
+        except BaseException:
+            handle.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        handle.close()
+        
+        key = digest.hexdigest()
+        target = self._path(key)
+        await asyncio.to_thread(target.parent.mkdir, parents=True, exist_ok=True)
+        # Mismo contenido ya almacenado: conservar una sola copia
+        await asyncio.to_thread(os.replace, tmp_path, target)
+        return {"blob_key": key, "size": size}
+
+    async def open(self, key: str, start: int, end: int):
+        path = self._path(key)
+        if not path.exists():
+            raise HTTPException(status_code=404, detail="Archivo no encontrado")
+        
+        async def chunks():
+            handle = await asyncio.to_thread(open, path, "rb")
+            try:
+                await asyncio.to_thread(handle.seek, start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await asyncio.to_thread(handle.read, min(BLOB_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            finally:
+                handle.close()
+        return chunks()
+
+class GridFSBlobStore:
+    # Blobs en GridFS; el nombre del archivo es el SHA-256
+
+    def __init__(self, database, bucket_name: str = "quotation_files"):
+        self.files = database[f"{bucket_name}.files"]
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name, chunk_size_bytes=BLOB_CHUNK_SIZE)
+
+    async def save(self, upload: UploadFile, max_bytes: int) -> dict:
+        digest = hashlib.sha256()
+        size = 0
+        grid_in = self.bucket.open_upload_stream(f"pending-{uuid.uuid4().hex}")
+        try:
+            while chunk := await upload.read(BLOB_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+                digest.update(chunk)
+                await grid_in.write(chunk)
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+        
+        key = digest.hexdigest()
+        if await self.files.find_one({"filename": key}, {"_id": 1}):
+            await self.bucket.delete(grid_in._id)
+        else:
+            await self.bucket.rename(grid_in._id, key)
+        return {"blob_key": key, "size": size}
+
+    async def open(self, key: str, start: int, end: int):
+        try:
+            grid_out = await self.bucket.open_download_stream_by_name(key)
+        except NoFile:
+            raise HTTPException(status_code=404, detail="Archivo no encontrado")
+        grid_out.seek(start)
+        
+        async def chunks():
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await grid_out.read(min(BLOB_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        return chunks()
+
+blob_store = LocalBlobStore(BLOB_STORE_PATH) if BLOB_STORE == "local" else GridFSBlobStore(db)
+
+def content_disposition(file_name: str) -> str:
+    # Nombre ASCII de respaldo (sin comillas ni saltos) y el original en filename* (RFC 5987)
+    fallback = re.sub(r'[^\x20-\x7e]|["\\]', "_", file_name) or "download"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(file_name, safe='')}"
+
+def parse_byte_range(range_header: Optional[str], size: int) -> Optional[tuple]:
+    # Un solo rango bytes= a (start, end) inclusivo; None = archivo completo
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    start_text, _, end_text = range_header[6:].split(",")[0].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+        else:
+            # bytes=-N: los últimos N bytes
+            start = max(size - int(end_text), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if size == 0 or start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Rango no válido", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
 
 # Auth Routes
 @api_router.post("/auth/register")
@@ -264,18 +1922,19 @@ async def register(user_data: UserRegister):
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    user_id = str(uuid.uuid4())
+    user_id = new_id()
     user_doc = {
         "id": user_id,
         "email": user_data.email,
-        "password_hash": hash_password(user_data.password),
+        "password_hash": await hash_password(user_data.password),
         "name": user_data.name,
         "role": user_data.role,
         "company": user_data.company,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.users.insert_one(user_doc)
+    await record_user_change(user_data.role, 1)
     
     token = create_access_token({"sub": user_id, "role": user_data.role})
     
@@ -293,9 +1952,16 @@ async def register(user_data: UserRegister):
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user_doc = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user_doc or not verify_password(credentials.password, user_doc["password_hash"]):
+    if not user_doc or not await verify_password(credentials.password, user_doc["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
+    # Migrar el hash al costo configurado; el filtro evita pisar un cambio de contraseña concurrente
+    if password_needs_rehash(user_doc["password_hash"]):
+        await db.users.update_one(
+            {"id": user_doc["id"], "password_hash": user_doc["password_hash"]},
+            {"$set": {"password_hash": await hash_password(credentials.password)}}
+        )
+    
     token = create_access_token({"sub": user_doc["id"], "role": user_doc["role"]})
     
     return {
@@ -316,9 +1982,14 @@ async def get_me(current_user: User = Depends(get_current_user)):
 # Product Routes
 @api_router.get("/products", response_model=List[Product])
 async def get_products(
+    response: Response,
     category: Optional[str] = None,
     supplier_id: Optional[str] = None,
     all_products: bool = False,
+    q: Optional[str] = Query(None, max_length=200),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user)
 ):
     query = {}
@@ -332,8 +2003,17 @@ async def get_products(
     if category:
         query["category"] = category
     
-    products = await db.products.find(query, {"_id": 0}).to_list(1000)
-    return products
+    q = q.strip() if q else None
+    not_modified = await check_not_modified(
+        "products", (query, q, limit, after), if_none_match, response, "private, no-cache"
+    )
+    if not_modified:
+        return not_modified
+    
+    if q:
+        return await search_products(query, q, limit)
+    
+    return await fetch_page(db.products, query, response, limit, after, direction=ASCENDING)
 
 @api_router.post("/products", response_model=Product)
 async def create_product(
@@ -344,18 +2024,11 @@ async def create_product(
         raise HTTPException(status_code=403, detail="Only suppliers can create products")
     
     # Calculate final price
-    final_price = product_data.base_price
-    
-    # Add profit
-    if product_data.profit_type == "percentage":
-        final_price += final_price * (product_data.profit_value / 100)
-    else:  # fixed
-        final_price += product_data.profit_value
-    
-    # Add IVA
-    final_price += final_price * (product_data.iva_percentage / 100)
+    final_price = calculate_price(
+        product_data.base_price, product_data.profit_type, product_data.profit_value, product_data.iva_percentage
+    )
     
-    product_id = str(uuid.uuid4())
+    product_id = new_id()
     product_doc = {
         "id": product_id,
         "name": product_data.name,
@@ -365,17 +2038,33 @@ async def create_product(
         "profit_type": product_data.profit_type,
         "profit_value": product_data.profit_value,
         "iva_percentage": product_data.iva_percentage,
-        "price": round(final_price, 2),
+        "price": final_price,
         "supplier_id": current_user.id,
         "supplier_name": current_user.name,
         "sku": product_data.sku,
         "image_url": product_data.image_url,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
+    product_doc["updated_at"] = product_doc["created_at"]
     
     await db.products.insert_one(product_doc)
+    supplier_products_cache.invalidate(current_user.id)
+    await bump_stats({"products_total": 1})
+    await bump_collection_version("products")
     return Product(**product_doc)
 
+@api_router.post("/products/import")
+async def import_products_by_supplier(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|jsonl)$"),
+    current_user: User = Depends(get_current_user)
+):
+    # Crear o actualizar el catálogo del proveedor desde CSV o JSONL, por SKU
+    if current_user.role != "proveedor":
+        raise HTTPException(status_code=403, detail="Only suppliers can import products")
+    
+    return await import_products(file, format, {"id": current_user.id, "name": current_user.name})
+
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(
     product_id: str,
@@ -390,16 +2079,9 @@ async def update_product(
         raise HTTPException(status_code=404, detail="Product not found")
     
     # Calculate final price
-    final_price = product_data.base_price
-    
-    # Add profit
-    if product_data.profit_type == "percentage":
-        final_price += final_price * (product_data.profit_value / 100)
-    else:  # fixed
-        final_price += product_data.profit_value
-    
-    # Add IVA
-    final_price += final_price * (product_data.iva_percentage / 100)
+    final_price = calculate_price(
+        product_data.base_price, product_data.profit_type, product_data.profit_value, product_data.iva_percentage
+    )
     
     update_data = {
         "name": product_data.name,
@@ -409,16 +2091,19 @@ async def update_product(
         "profit_type": product_data.profit_type,
         "profit_value": product_data.profit_value,
         "iva_percentage": product_data.iva_percentage,
-        "price": round(final_price, 2),
+        "price": final_price,
         "sku": product_data.sku,
         "image_url": product_data.image_url,
-        "supplier_name": current_user.name
+        "supplier_name": current_user.name,
+        "updated_at": datetime.now(timezone.utc)
     }
     
     await db.products.update_one(
         {"id": product_id},
         {"$set": update_data}
     )
+    supplier_products_cache.invalidate(existing["supplier_id"])
+    await bump_collection_version("products")
     
     updated = await db.products.find_one({"id": product_id}, {"_id": 0})
     return Product(**updated)
@@ -432,48 +2117,24 @@ async def delete_product(
         raise HTTPException(status_code=403, detail="Only suppliers can delete products")
     
     result = await db.products.delete_one({"id": product_id, "supplier_id": current_user.id})
+    supplier_products_cache.invalidate(current_user.id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await bump_stats({"products_total": -1})
+    await record_tombstone("products", product_id)
+    await bump_collection_version("products")
     
     return {"message": "Product deleted successfully"}
 
 # Order Routes
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: User = Depends(get_current_user)):
-    if current_user.role == "cliente":
-        query = {"client_id": current_user.id}
-    elif current_user.role == "proveedor":
-        # Obtener los IDs de productos del proveedor
-        supplier_products = await db.products.find(
-            {"supplier_id": current_user.id},
-            {"_id": 0, "id": 1}
-        ).to_list(1000)
-        
-        supplier_product_ids = [p["id"] for p in supplier_products]
-        
-        # Proveedores ven:
-        # 1. Órdenes asignadas directamente a ellos
-        # 2. Órdenes con productos de su catálogo
-        # 3. Órdenes con productos personalizados (para que puedan cotizar)
-        or_conditions = [
-            {"supplier_id": current_user.id},
-            {"assigned_to": current_user.id}
-        ]
-        
-        # Si tiene productos, incluir órdenes con esos productos
-        if supplier_product_ids:
-            or_conditions.append({"products.product_id": {"$in": supplier_product_ids}})
-        
-        # Incluir órdenes con productos personalizados (cualquier proveedor puede cotizar)
-        or_conditions.append({"products.is_custom": True})
-        
-        query = {"$or": or_conditions}
-    else:
-        # Admin ve todas las órdenes
-        query = {}
-    
-    orders = await db.orders.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return orders
+async def get_orders(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    return await fetch_page(db.orders, order_scope_query(current_user), response, limit, after)
 
 @api_router.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: str, current_user: User = Depends(get_current_user)):
@@ -497,6 +2158,20 @@ async def create_order(
     if current_user.role != "cliente":
         raise HTTPException(status_code=403, detail="Only clients can create orders")
     
+    # Resolver todos los productos de catálogo en una sola consulta
+    catalog_ids = list({p.product_id for p in order_data.products if not p.is_custom})
+    db_products = {}
+    if catalog_ids:
+        found = await db.products.find(
+            {"id": {"$in": catalog_ids}},
+            {"_id": 0, "id": 1, "name": 1, "supplier_id": 1, "category": 1}
+        ).to_list(len(catalog_ids))
+        db_products = {p["id"]: p for p in found}
+    
+    missing_ids = [pid for pid in catalog_ids if pid not in db_products]
+    if missing_ids:
+        raise HTTPException(status_code=404, detail=f"Products not found: {', '.join(sorted(str(pid) for pid in missing_ids))}")
+    
     # Process products - NO asignar proveedor automáticamente
     # El proveedor se asignará cuando seleccione la orden
     processed_products = []
@@ -515,24 +2190,24 @@ async def create_order(
             }
         else:
             # Existing product from database
-            db_product = await db.products.find_one({"id": product.product_id}, {"_id": 0})
-            if not db_product:
-                raise HTTPException(status_code=404, detail=f"Product {product.product_id} not found")
-            
+            db_product = db_products[product.product_id]
             processed_product = {
                 "product_id": product.product_id,
                 "product_name": db_product["name"],
                 "quantity": product.quantity,
                 "price": None,  # NO mostrar precio hasta que proveedor actualice
                 "supplier_id": db_product["supplier_id"],  # Guardar referencia del proveedor del producto
+                "category": db_product.get("category"),
                 "is_custom": False
             }
         
         processed_products.append(processed_product)
     
     # NO asignar proveedor automáticamente - se asignará cuando el proveedor tome la orden
-    order_id = str(uuid.uuid4())
-    order_number = f"ORD-{datetime.now(timezone.utc).strftime('%Y%m%d')}-{order_id[:8].upper()}"
+    order_id = new_id()
+    # Fecha y número salen del id: el sufijo usa los bits aleatorios del final
+    created_at = id_timestamp(order_id)
+    order_number = f"ORD-{created_at.strftime('%Y%m%d')}-{order_id[-8:].upper()}"
     
     order_doc = {
         "id": order_id,
@@ -542,17 +2217,21 @@ async def create_order(
         "supplier_id": None,  # Se asignará cuando el proveedor tome la orden
         "supplier_name": None,
         "products": processed_products,
+        **order_supplier_fields(processed_products),
         "total": 0,  # Total será calculado cuando proveedor agregue precios
         "status": "pendiente",
         "assigned_to": None,
         "notes": order_data.notes,
         "requested_by": current_user.name,
         "price_confirmed": False,  # Nuevo campo para saber si el proveedor confirmó precios
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "version": 0,
+        "created_at": created_at,
+        "updated_at": created_at
     }
     
     await db.orders.insert_one(order_doc)
+    await record_order_change(None, order_doc)
+    publish_order_event("order.created", order_doc)
     
     return Order(**order_doc)
 
@@ -565,66 +2244,77 @@ async def update_order_status(
     if current_user.role != "proveedor":
         raise HTTPException(status_code=403, detail="Only suppliers can update order status")
     
-    # Buscar la orden - el proveedor puede actualizar si:
+    # El proveedor puede actualizar si:
     # 1. Ya está asignado a la orden
-    # 2. La orden tiene productos de su catálogo y no tiene proveedor asignado
-    order = await db.orders.find_one({"id": order_id}, {"_id": 0})
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    # Verificar si el proveedor puede tomar/actualizar esta orden
-    can_update = False
-    
-    # Si ya es el proveedor asignado
-    if order.get("supplier_id") == current_user.id:
-        can_update = True
-    # Si la orden no tiene proveedor asignado, verificar si tiene productos del proveedor
-    elif order.get("supplier_id") is None:
-        # Obtener IDs de productos del proveedor
-        supplier_products = await db.products.find(
-            {"supplier_id": current_user.id},
-            {"_id": 0, "id": 1}
-        ).to_list(1000)
-        supplier_product_ids = [p["id"] for p in supplier_products]
-        
-        # Verificar si algún producto de la orden pertenece al proveedor
-        for product in order.get("products", []):
-            if product.get("product_id") in supplier_product_ids:
-                can_update = True
-                break
-            # También permitir si tiene productos personalizados (cualquier proveedor puede cotizar)
-            if product.get("is_custom"):
-                can_update = True
-                break
-    
-    if not can_update:
-        raise HTTPException(status_code=403, detail="No tienes permiso para actualizar esta orden")
-    
+    # 2. La orden no tiene proveedor y tiene productos de su catálogo o personalizados
+    # Si la orden no tiene proveedor, se asigna automáticamente en la misma operación
     update_data = {
         "status": status_data.status,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "supplier_id": current_user.id,
+        "supplier_name": current_user.name,
+        "updated_at": datetime.now(timezone.utc)
     }
     
-    # Si la orden no tiene proveedor y el proveedor está actualizando, asignarse automáticamente
-    if order.get("supplier_id") is None:
-        update_data["supplier_id"] = current_user.id
-        update_data["supplier_name"] = current_user.name
-    
     if status_data.assigned_to:
         update_data["assigned_to"] = status_data.assigned_to
     
-    await db.orders.update_one(
+    conditions = [
         {"id": order_id},
-        {"$set": update_data}
+        {"$or": [
+            {"supplier_id": current_user.id},
+            {"supplier_id": None, "$or": [{"supplier_ids": current_user.id}, {"has_custom": True}]}
+        ]}
+    ]
+    if status_data.expected_version is not None:
+        conditions.append(order_version_filter(status_data.expected_version))
+    
+    before = await db.orders.find_one_and_update(
+        {"$and": conditions},
+        {"$set": update_data, "$inc": {"version": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
     )
     
+    if not before:
+        # Solo en el camino de error: averiguar por qué no se aplicó
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        
+        version = order.get("version", 0)
+        if status_data.expected_version is not None and status_data.expected_version != version:
+            raise order_conflict()
+        
+        # Orden aún sin supplier_ids: validar contra el catálogo y aplicar condicionado a la versión leída
+        can_update = (
+            order.get("supplier_id") is None
+            and "supplier_ids" not in order
+            and await supplier_can_access_order(order, current_user.id)
+        )
+        if not can_update:
+            raise HTTPException(status_code=403, detail="No tienes permiso para actualizar esta orden")
+        
+        before = await db.orders.find_one_and_update(
+            {"id": order_id, "supplier_id": None, **order_version_filter(version)},
+            {"$set": update_data, "$inc": {"version": 1}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not before:
+            raise order_conflict()
+    
+    updated = apply_order_update(before, update_data)
+    await record_order_change(before, updated)
+    publish_order_event("order.updated", updated)
+    
     # Create notification for client
     await create_notification(
-        order["client_id"],
-        f"Estado de orden {order['order_number']} actualizado a: {status_data.status} por {current_user.name}"
+        updated["client_id"],
+        f"Estado de orden {updated['order_number']} actualizado a: {status_data.status} por {current_user.name}",
+        order_id=updated["id"],
+        kind="status"
     )
     
-    updated = await db.orders.find_one({"id": order_id}, {"_id": 0})
     return Order(**updated)
 
 # Nuevo endpoint para que el proveedor tome una orden y agregue precios
@@ -645,18 +2335,12 @@ async def take_order_and_set_prices(
     if order.get("supplier_id") and order.get("supplier_id") != current_user.id:
         raise HTTPException(status_code=400, detail="Esta orden ya tiene un proveedor asignado")
     
+    version = order.get("version", 0)
+    if data.expected_version is not None and data.expected_version != version:
+        raise order_conflict()
+    
     # Verificar acceso a la orden
-    can_take = False
-    supplier_products = await db.products.find(
-        {"supplier_id": current_user.id},
-        {"_id": 0, "id": 1}
-    ).to_list(1000)
-    supplier_product_ids = [p["id"] for p in supplier_products]
-    
-    for product in order.get("products", []):
-        if product.get("product_id") in supplier_product_ids or product.get("is_custom"):
-            can_take = True
-            break
+    can_take = await supplier_can_access_order(order, current_user.id)
     
     if not can_take and order.get("supplier_id") != current_user.id:
         raise HTTPException(status_code=403, detail="No tienes permiso para tomar esta orden")
@@ -683,24 +2367,33 @@ async def take_order_and_set_prices(
         "products": products,
         "total": round(total, 2),
         "price_confirmed": True,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
     
     if data.assigned_to:
         update_data["assigned_to"] = data.assigned_to
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": update_data}
+    # Reclamar solo si sigue sin proveedor (o es el mismo) y nadie la modificó desde la lectura
+    before = await db.orders.find_one_and_update(
+        {"id": order_id, "supplier_id": {"$in": [None, current_user.id]}, **order_version_filter(version)},
+        {"$set": update_data, "$inc": {"version": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
     )
+    if not before:
+        raise order_conflict()
+    
+    updated = apply_order_update(before, update_data)
+    await record_order_change(before, updated)
+    publish_order_event("order.updated", updated)
     
     # Notificar al cliente
     await create_notification(
-        order["client_id"],
-        f"El proveedor {current_user.name} ha tomado tu orden {order['order_number']} y agregado cotización"
+        updated["client_id"],
+        f"El proveedor {current_user.name} ha tomado tu orden {updated['order_number']} y agregado cotización",
+        order_id=updated["id"]
     )
     
-    updated = await db.orders.find_one({"id": order_id}, {"_id": 0})
     return Order(**updated)
 
 # Quotation Routes
@@ -719,29 +2412,32 @@ async def upload_quotation(
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    # Read file and encode to base64
-    file_content = await file.read()
-    file_data = base64.b64encode(file_content).decode('utf-8')
+    # Guardar el archivo por bloques en el blob store; en Mongo solo quedan los metadatos
+    stored = await blob_store.save(file, QUOTATION_MAX_BYTES)
     
-    quotation_id = str(uuid.uuid4())
+    quotation_id = new_id()
     quotation_doc = {
         "id": quotation_id,
         "order_id": order_id,
         "supplier_id": current_user.id,
         "supplier_name": current_user.name,
-        "file_data": file_data,
         "file_name": file.filename,
+        "content_type": file.content_type or "application/octet-stream",
+        "size": stored["size"],
+        "blob_key": stored["blob_key"],
         "amount": amount,
         "notes": notes,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": id_timestamp(quotation_id)
     }
     
     await db.quotations.insert_one(quotation_doc)
+    publish_quotation_event(order, Quotation(**quotation_doc).model_dump())
     
     # Create notification for client
     await create_notification(
         order["client_id"],
-        f"Nueva cotización recibida para orden {order['order_number']}"
+        f"Nueva cotización recibida para orden {order['order_number']}",
+        order_id=order["id"]
     )
     
     return Quotation(**quotation_doc)
@@ -749,6 +2445,9 @@ async def upload_quotation(
 @api_router.get("/orders/{order_id}/quotations", response_model=List[Quotation])
 async def get_quotations(
     order_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
     # Verify access to order
@@ -761,8 +2460,59 @@ async def get_quotations(
     if current_user.role == "proveedor" and order["supplier_id"] != current_user.id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    quotations = await db.quotations.find({"order_id": order_id}, {"_id": 0}).to_list(1000)
-    return quotations
+    # Solo metadatos: los archivos se descargan por separado
+    return await fetch_page(
+        db.quotations, {"order_id": order_id}, response, limit, after,
+        direction=ASCENDING, projection={"_id": 0, "file_data": 0}
+    )
+
+@api_router.get("/orders/{order_id}/quotations/{quotation_id}/file")
+async def download_quotation_file(
+    order_id: str,
+    quotation_id: str,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    current_user: User = Depends(get_current_user)
+):
+    order = await db.orders.find_one({"id": order_id}, {"_id": 0, "client_id": 1, "supplier_id": 1})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    if current_user.role == "cliente" and order["client_id"] != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if current_user.role == "proveedor" and order["supplier_id"] != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    quotation = await db.quotations.find_one({"id": quotation_id, "order_id": order_id}, {"_id": 0})
+    if not quotation:
+        raise HTTPException(status_code=404, detail="Cotización no encontrada")
+    
+    if quotation.get("blob_key"):
+        size = quotation["size"]
+        byte_range = parse_byte_range(range_header, size)
+        start, end = byte_range or (0, size - 1)
+        body = await blob_store.open(quotation["blob_key"], start, end)
+    else:
+        # Cotizaciones que migrate_quotation_files aún no movió (o no pudo mover)
+        content = base64.b64decode(quotation.get("file_data", ""))
+        size = len(content)
+        byte_range = parse_byte_range(range_header, size)
+        start, end = byte_range or (0, size - 1)
+        body = iter([content[start:end + 1]])
+    
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": content_disposition(quotation["file_name"])
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    return StreamingResponse(
+        body,
+        status_code=206 if byte_range else 200,
+        media_type=quotation.get("content_type") or "application/pdf",
+        headers=headers
+    )
 
 # Notification Routes
 @api_router.get("/notifications", response_model=List[Notification])
@@ -770,7 +2520,7 @@ async def get_notifications(current_user: User = Depends(get_current_user)):
     notifications = await db.notifications.find(
         {"user_id": current_user.id},
         {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
+    ).sort([("created_at", DESCENDING), ("id", DESCENDING)]).to_list(100)
     return notifications
 
 @api_router.put("/notifications/{notification_id}/read")
@@ -779,20 +2529,190 @@ async def mark_notification_read(
     current_user: User = Depends(get_current_user)
 ):
     result = await db.notifications.update_one(
-        {"id": notification_id, "user_id": current_user.id},
-        {"$set": {"read": True}}
+        {"id": notification_id, "user_id": current_user.id, "read": False},
+        notification_read_update()
     )
     
-    if result.matched_count == 0:
+    if result.matched_count:
+        await record_unread_changes({current_user.id: -1})
+    elif not await db.notifications.find_one({"id": notification_id, "user_id": current_user.id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Notification not found")
     
     return {"message": "Notification marked as read"}
 
+@api_router.get("/notifications/unread-count")
+async def get_unread_notification_count(current_user: User = Depends(get_current_user)):
+    counter = await db.notification_counters.find_one({"_id": current_user.id})
+    return {"unread": max(0, counter["unread"]) if counter else 0}
+
+@api_router.put("/notifications/read")
+async def mark_notifications_read(
+    selection: NotificationsMarkRead,
+    current_user: User = Depends(get_current_user)
+):
+    query = {"user_id": current_user.id, "read": False}
+    if selection.ids is not None:
+        query["id"] = {"$in": selection.ids}
+    
+    result = await db.notifications.update_many(
+        query,
+        notification_read_update()
+    )
+    if result.modified_count:
+        await record_unread_changes({current_user.id: -result.modified_count})
+    
+    return {"marked": result.modified_count}
+
+# Sync Routes (delta sync for clients on slow links)
+@api_router.get("/sync")
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = Query(SYNC_MAX_ITEMS, ge=1, le=SYNC_MAX_ITEMS),
+    current_user: User = Depends(get_current_user)
+):
+    # Cambios y borrados desde el token; sin token, o con uno vencido, devuelve snapshot completo
+    now = datetime.now(timezone.utc)
+    floor = now - timedelta(seconds=SYNC_CLOCK_SKEW_SECONDS)
+    
+    sources = {
+        "orders": (db.orders, order_scope_query(current_user)),
+        "products": (db.products, {"supplier_id": current_user.id} if current_user.role == "proveedor" else {}),
+        "categories": (db.categories, {}),
+        "notifications": (db.notifications, {"user_id": current_user.id}),
+    }
+    
+    watermarks = decode_sync_token(since) if since else {}
+    tombstone_mark = watermarks.get("tombstones")
+    oldest_allowed = now - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    # Tokens emitidos antes de guardar fechas nativas llevan texto: tratarlos como vencidos
+    full = not tombstone_mark or not isinstance(tombstone_mark[0], datetime) or tombstone_mark[0] < oldest_allowed
+    if full:
+        # Instantánea completa; los borrados anteriores ya no importan
+        watermarks = {name: [None, ""] for name in sources}
+        watermarks["tombstones"] = [floor, ""]
+    
+    changes = {}
+    has_more = False
+    next_watermarks = {}
+    for name, (collection, query) in sources.items():
+        value, last_id = watermarks.get(name) or [None, ""]
+        if not isinstance(value, datetime):
+            value, last_id = None, ""
+        docs = await collection.find(
+            keyset_query(query, "updated_at", value, last_id) if value is not None else query,
+            {"_id": 0, "file_data": 0}
+        ).sort([("updated_at", ASCENDING), ("id", ASCENDING)]).limit(limit + 1).to_list(limit + 1)
+        
+        if len(docs) > limit:
+            docs = docs[:limit]
+            has_more = True
+            next_watermarks[name] = [docs[-1]["updated_at"], docs[-1]["id"]]
+        else:
+            next_watermarks[name] = [value, last_id] if value is not None and value >= floor else [floor, ""]
+        changes[name] = docs
+    
+    deleted = {name: [] for name in sources}
+    if not full:
+        value, last_id = tombstone_mark
+        audience = {} if current_user.role == "admin" else {"$or": [
+            {"user_ids": None, "roles": None},
+            {"user_ids": current_user.id},
+            {"roles": current_user.role}
+        ]}
+        tombstones = await db.tombstones.find(
+            keyset_query(audience, "deleted_at", value, last_id),
+            {"_id": 0, "id": 1, "collection": 1, "deleted_at": 1}
+        ).sort([("deleted_at", ASCENDING), ("id", ASCENDING)]).limit(limit + 1).to_list(limit + 1)
+        
+        if len(tombstones) > limit:
+            tombstones = tombstones[:limit]
+            has_more = True
+            next_watermarks["tombstones"] = [tombstones[-1]["deleted_at"], tombstones[-1]["id"]]
+        else:
+            next_watermarks["tombstones"] = [value, last_id] if value >= floor else [floor, ""]
+        for tombstone in tombstones:
+            if tombstone["collection"] in deleted:
+                deleted[tombstone["collection"]].append(tombstone["id"])
+    else:
+        next_watermarks["tombstones"] = watermarks["tombstones"]
+    
+    return {
+        "token": encode_sync_token(next_watermarks),
+        "full": full,
+        "has_more": has_more,
+        "changes": changes,
+        "deleted": deleted
+    }
+
+# Event Routes (server push instead of polling /orders and /notifications)
+@api_router.post("/events/token")
+async def create_events_token(current_user: User = Depends(get_current_user)):
+    expire = datetime.now(timezone.utc) + timedelta(seconds=SSE_TOKEN_EXPIRE_SECONDS)
+    token = jwt.encode({"sub": current_user.id, "scope": "events", "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+    return {"token": token, "expires_in": SSE_TOKEN_EXPIRE_SECONDS}
+
+@api_router.get("/events")
+async def stream_events(
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    # EventSource no puede mandar headers: ?token= solo acepta el token corto de /events/token
+    if credentials:
+        current_user = await user_from_token(credentials.credentials)
+    elif token:
+        current_user = await user_from_token(token, scope="events")
+    else:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    subscription_id, queue = event_hub.subscribe(current_user)
+    
+    async def event_stream():
+        try:
+            yield f"retry: {int(SSE_KEEPALIVE_SECONDS * 1000)}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event['data'], default=json_default)}\n\n"
+        finally:
+            event_hub.unsubscribe(subscription_id)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Category Routes (Public for listing)
 @api_router.get("/categories", response_model=List[Category])
-async def get_categories():
-    categories = await db.categories.find({}, {"_id": 0}).to_list(1000)
-    return categories
+async def get_categories(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
+):
+    # Versión cacheada: un acierto no toca Mongo
+    not_modified = await check_not_modified(
+        "categories", (limit, after), if_none_match, response, "public, no-cache", cached_version=True
+    )
+    if not_modified:
+        return not_modified
+    
+    etag = response.headers["ETag"]
+    cached = category_cache.get(etag)
+    if cached is None:
+        categories = await fetch_page(db.categories, {}, response, limit, after, direction=ASCENDING)
+        body = category_list_adapter.dump_json(category_list_adapter.validate_python(categories))
+        cached = (body, response.headers.get("X-Next-Cursor"))
+        category_cache.set(etag, cached)
+    
+    body, next_cursor = cached
+    headers = {name: response.headers[name] for name in ("ETag", "Cache-Control", "Vary", "Last-Modified")}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @api_router.post("/categories", response_model=Category)
 async def create_category_by_supplier(
@@ -806,17 +2726,19 @@ async def create_category_by_supplier(
     if existing:
         raise HTTPException(status_code=400, detail="Esta categoría ya existe")
     
-    category_id = str(uuid.uuid4())
+    category_id = new_id()
     category_doc = {
         "id": category_id,
         "name": category_data.name,
         "slug": category_data.slug,
         "description": category_data.description,
         "created_by": current_user.id,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
+    category_doc["updated_at"] = category_doc["created_at"]
     
     await db.categories.insert_one(category_doc)
+    await bump_collection_version("categories")
     return Category(**category_doc)
 
 @api_router.delete("/categories/{category_id}")
@@ -830,6 +2752,8 @@ async def delete_category_by_supplier(
     result = await db.categories.delete_one({"id": category_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Categoría no encontrada")
+    await record_tombstone("categories", category_id)
+    await bump_collection_version("categories")
     
     return {"message": "Categoría eliminada exitosamente"}
 
@@ -849,7 +2773,7 @@ async def create_registration_request(request_data: RegistrationRequestCreate):
     if existing_request:
         raise HTTPException(status_code=400, detail="Ya existe una solicitud pendiente con este correo")
     
-    request_id = str(uuid.uuid4())
+    request_id = new_id()
     request_doc = {
         "id": request_id,
         "boat_name": request_data.boat_name,
@@ -857,27 +2781,30 @@ async def create_registration_request(request_data: RegistrationRequestCreate):
         "phone": request_data.phone,
         "email": request_data.email,
         "status": "pendiente",
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc),
         "processed_by": None,
         "processed_at": None
     }
     
     await db.registration_requests.insert_one(request_doc)
+    await bump_stats({stats_key("registration_requests_by_status", "pendiente"): 1})
     
     return {"message": "Solicitud enviada exitosamente. El equipo de Mar de Cortez se pondrá en contacto contigo.", "id": request_id}
 
 # Admin Routes
 @api_router.get("/admin/registration-requests", response_model=List[RegistrationRequest])
 async def get_registration_requests(
+    response: Response,
     status: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
     admin_user: User = Depends(get_admin_user)
 ):
     query = {}
     if status:
         query["status"] = status
     
-    requests = await db.registration_requests.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return requests
+    return await fetch_page(db.registration_requests, query, response, limit, after)
 
 @api_router.put("/admin/registration-requests/{request_id}/approve")
 async def approve_registration_request(
@@ -893,28 +2820,35 @@ async def approve_registration_request(
         raise HTTPException(status_code=400, detail="Esta solicitud ya fue procesada")
     
     # Create user
-    user_id = str(uuid.uuid4())
+    user_id = new_id()
     new_user = {
         "id": user_id,
         "email": user_data.email,
-        "password_hash": hash_password(user_data.password),
+        "password_hash": await hash_password(user_data.password),
         "name": user_data.name,
         "role": user_data.role,
         "company": user_data.company,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.users.insert_one(new_user)
+    user_cache.invalidate(user_id)
+    await record_user_change(user_data.role, 1)
     
     # Update request status
-    await db.registration_requests.update_one(
-        {"id": request_id},
+    result = await db.registration_requests.update_one(
+        {"id": request_id, "status": "pendiente"},
         {"$set": {
             "status": "aprobado",
             "processed_by": admin_user.id,
-            "processed_at": datetime.now(timezone.utc).isoformat()
+            "processed_at": datetime.now(timezone.utc)
         }}
     )
+    if result.modified_count:
+        await bump_stats({
+            stats_key("registration_requests_by_status", "pendiente"): -1,
+            stats_key("registration_requests_by_status", "aprobado"): 1
+        })
     
     return {"message": "Solicitud aprobada y usuario creado", "user_id": user_id}
 
@@ -930,14 +2864,19 @@ async def reject_registration_request(
     if request_doc["status"] != "pendiente":
         raise HTTPException(status_code=400, detail="Esta solicitud ya fue procesada")
     
-    await db.registration_requests.update_one(
-        {"id": request_id},
+    result = await db.registration_requests.update_one(
+        {"id": request_id, "status": "pendiente"},
         {"$set": {
             "status": "rechazado",
             "processed_by": admin_user.id,
-            "processed_at": datetime.now(timezone.utc).isoformat()
+            "processed_at": datetime.now(timezone.utc)
         }}
     )
+    if result.modified_count:
+        await bump_stats({
+            stats_key("registration_requests_by_status", "pendiente"): -1,
+            stats_key("registration_requests_by_status", "rechazado"): 1
+        })
     
     return {"message": "Solicitud rechazada"}
 
@@ -950,31 +2889,34 @@ async def create_user_by_admin(
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    user_id = str(uuid.uuid4())
+    user_id = new_id()
     user_doc = {
         "id": user_id,
         "email": user_data.email,
-        "password_hash": hash_password(user_data.password),
+        "password_hash": await hash_password(user_data.password),
         "name": user_data.name,
         "role": user_data.role,
         "company": user_data.company,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.users.insert_one(user_doc)
+    await record_user_change(user_data.role, 1)
     return User(**user_doc)
 
 @api_router.get("/admin/users", response_model=List[User])
 async def get_all_users(
+    response: Response,
     role: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
     admin_user: User = Depends(get_admin_user)
 ):
     query = {}
     if role:
         query["role"] = role
     
-    users = await db.users.find(query, {"_id": 0}).to_list(1000)
-    return users
+    return await fetch_page(db.users, query, response, limit, after, direction=ASCENDING)
 
 @api_router.put("/admin/users/{user_id}", response_model=User)
 async def update_user(
@@ -998,10 +2940,11 @@ async def update_user(
     if user_data.company is not None:
         update_data["company"] = user_data.company
     if user_data.password:
-        update_data["password_hash"] = hash_password(user_data.password)
+        update_data["password_hash"] = await hash_password(user_data.password)
     
     if update_data:
         await db.users.update_one({"id": user_id}, {"$set": update_data})
+        user_cache.invalidate(user_id)
     
     updated = await db.users.find_one({"id": user_id}, {"_id": 0})
     return User(**updated)
@@ -1020,15 +2963,21 @@ async def delete_user(
         raise HTTPException(status_code=400, detail="No se pueden eliminar usuarios administradores")
     
     result = await db.users.delete_one({"id": user_id})
+    user_cache.invalidate(user_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    await record_user_change(user["role"], -1)
     
     return {"message": "Usuario eliminado exitosamente"}
 
 @api_router.get("/admin/orders", response_model=List[Order])
-async def get_all_orders(admin_user: User = Depends(get_admin_user)):
-    orders = await db.orders.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return orders
+async def get_all_orders(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    admin_user: User = Depends(get_admin_user)
+):
+    return await fetch_page(db.orders, {}, response, limit, after)
 
 @api_router.put("/admin/orders/{order_id}/status")
 async def update_order_status_by_admin(
@@ -1037,13 +2986,9 @@ async def update_order_status_by_admin(
     cancellation_reason: Optional[str] = None,
     admin_user: User = Depends(get_admin_user)
 ):
-    order = await db.orders.find_one({"id": order_id}, {"_id": 0})
-    if not order:
-        raise HTTPException(status_code=404, detail="Orden no encontrada")
-    
     update_data = {
         "status": status_data.status,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
     
     if status_data.assigned_to:
@@ -1052,18 +2997,33 @@ async def update_order_status_by_admin(
     if status_data.status == "cancelado" and cancellation_reason:
         update_data["cancellation_reason"] = cancellation_reason
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": update_data}
+    query = {"id": order_id}
+    if status_data.expected_version is not None:
+        query.update(order_version_filter(status_data.expected_version))
+    
+    before = await db.orders.find_one_and_update(
+        query,
+        {"$set": update_data, "$inc": {"version": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
     )
+    if not before:
+        if status_data.expected_version is not None and await db.orders.count_documents({"id": order_id}, limit=1):
+            raise order_conflict()
+        raise HTTPException(status_code=404, detail="Orden no encontrada")
+    
+    updated = apply_order_update(before, update_data)
+    await record_order_change(before, updated)
+    publish_order_event("order.updated", updated)
     
     # Notify client
     await create_notification(
-        order["client_id"],
-        f"Estado de orden {order['order_number']} actualizado a: {status_data.status}"
+        updated["client_id"],
+        f"Estado de orden {updated['order_number']} actualizado a: {status_data.status}",
+        order_id=updated["id"],
+        kind="status"
     )
     
-    updated = await db.orders.find_one({"id": order_id}, {"_id": 0})
     return Order(**updated)
 
 @api_router.delete("/admin/orders/{order_id}")
@@ -1082,16 +3042,24 @@ async def delete_order_by_admin(
             detail="Solo se pueden eliminar órdenes canceladas"
         )
     
-    result = await db.orders.delete_one({"id": order_id})
+    result = await db.orders.delete_one({"id": order_id, "status": "cancelado"})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Orden no encontrada")
+    await record_order_change(order, None)
+    user_ids, roles = order_audience(order)
+    await record_tombstone("orders", order_id, user_ids=user_ids, roles=roles)
+    publish_order_event("order.deleted", order, {"id": order_id})
     
     return {"message": "Orden eliminada exitosamente"}
 
 @api_router.get("/admin/products", response_model=List[Product])
-async def get_all_products(admin_user: User = Depends(get_admin_user)):
-    products = await db.products.find({}, {"_id": 0}).to_list(1000)
-    return products
+async def get_all_products(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    admin_user: User = Depends(get_admin_user)
+):
+    return await fetch_page(db.products, {}, response, limit, after, direction=ASCENDING)
 
 @api_router.post("/admin/products", response_model=Product)
 async def create_product_by_admin(
@@ -1105,18 +3073,11 @@ async def create_product_by_admin(
         raise HTTPException(status_code=404, detail="Proveedor no encontrado")
     
     # Calculate final price
-    final_price = product_data.base_price
-    
-    # Add profit
-    if product_data.profit_type == "percentage":
-        final_price += final_price * (product_data.profit_value / 100)
-    else:  # fixed
-        final_price += product_data.profit_value
-    
-    # Add IVA
-    final_price += final_price * (product_data.iva_percentage / 100)
+    final_price = calculate_price(
+        product_data.base_price, product_data.profit_type, product_data.profit_value, product_data.iva_percentage
+    )
     
-    product_id = str(uuid.uuid4())
+    product_id = new_id()
     product_doc = {
         "id": product_id,
         "name": product_data.name,
@@ -1126,17 +3087,34 @@ async def create_product_by_admin(
         "profit_type": product_data.profit_type,
         "profit_value": product_data.profit_value,
         "iva_percentage": product_data.iva_percentage,
-        "price": round(final_price, 2),
+        "price": final_price,
         "supplier_id": supplier_id,
         "supplier_name": supplier["name"],
         "sku": product_data.sku,
         "image_url": product_data.image_url,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
+    product_doc["updated_at"] = product_doc["created_at"]
     
     await db.products.insert_one(product_doc)
+    supplier_products_cache.invalidate(supplier_id)
+    await bump_stats({"products_total": 1})
+    await bump_collection_version("products")
     return Product(**product_doc)
 
+@api_router.post("/admin/products/import")
+async def import_products_by_admin(
+    supplier_id: str,
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|jsonl)$"),
+    admin_user: User = Depends(get_admin_user)
+):
+    supplier = await db.users.find_one({"id": supplier_id, "role": "proveedor"}, {"_id": 0, "id": 1, "name": 1})
+    if not supplier:
+        raise HTTPException(status_code=404, detail="Proveedor no encontrado")
+    
+    return await import_products(file, format, supplier)
+
 @api_router.put("/admin/products/{product_id}", response_model=Product)
 async def update_product_by_admin(
     product_id: str,
@@ -1148,16 +3126,9 @@ async def update_product_by_admin(
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     
     # Calculate final price
-    final_price = product_data.base_price
-    
-    # Add profit
-    if product_data.profit_type == "percentage":
-        final_price += final_price * (product_data.profit_value / 100)
-    else:  # fixed
-        final_price += product_data.profit_value
-    
-    # Add IVA
-    final_price += final_price * (product_data.iva_percentage / 100)
+    final_price = calculate_price(
+        product_data.base_price, product_data.profit_type, product_data.profit_value, product_data.iva_percentage
+    )
     
     update_data = {
         "name": product_data.name,
@@ -1167,15 +3138,18 @@ async def update_product_by_admin(
         "profit_type": product_data.profit_type,
         "profit_value": product_data.profit_value,
         "iva_percentage": product_data.iva_percentage,
-        "price": round(final_price, 2),
+        "price": final_price,
         "sku": product_data.sku,
-        "image_url": product_data.image_url
+        "image_url": product_data.image_url,
+        "updated_at": datetime.now(timezone.utc)
     }
     
     await db.products.update_one(
         {"id": product_id},
         {"$set": update_data}
     )
+    supplier_products_cache.invalidate(existing["supplier_id"])
+    await bump_collection_version("products")
     
     updated = await db.products.find_one({"id": product_id}, {"_id": 0})
     return Product(**updated)
@@ -1185,12 +3159,77 @@ async def delete_product_by_admin(
     product_id: str,
     admin_user: User = Depends(get_admin_user)
 ):
-    result = await db.products.delete_one({"id": product_id})
-    if result.deleted_count == 0:
+    deleted = await db.products.find_one_and_delete({"id": product_id}, {"_id": 0, "supplier_id": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
+    supplier_products_cache.invalidate(deleted.get("supplier_id"))
+    await bump_stats({"products_total": -1})
+    await record_tombstone("products", product_id)
+    await bump_collection_version("products")
     
     return {"message": "Producto eliminado exitosamente"}
 
+@api_router.post("/admin/products/reprice")
+async def reprice_products(
+    reprice: ProductReprice,
+    admin_user: User = Depends(get_admin_user)
+):
+    # Recalcular price de los productos filtrados, aplicando antes IVA/ganancia nuevos
+    if reprice.profit_type is not None and reprice.profit_type not in (PROFIT_PERCENTAGE, PROFIT_FIXED):
+        raise HTTPException(status_code=400, detail="profit_type debe ser 'percentage' o 'fixed'")
+    
+    query = {}
+    if reprice.supplier_id:
+        query["supplier_id"] = reprice.supplier_id
+    if reprice.category:
+        query["category"] = reprice.category
+    overrides = reprice.model_dump(include={"iva_percentage", "profit_type", "profit_value"}, exclude_none=True)
+    
+    # Productos antiguos sin base_price numérico no se pueden recalcular
+    skipped = await db.products.count_documents({**query, "base_price": {"$not": {"$type": "number"}}})
+    result = {"matched": 0, "updated": 0, "skipped": skipped}
+    defaults = {"profit_type": PROFIT_PERCENTAGE, "profit_value": 0.0, "iva_percentage": 16.0}
+    
+    async def write(batch: list):
+        rows = [{
+            "base_price": product["base_price"],
+            **{key: default if product.get(key) is None else product[key] for key, default in defaults.items()},
+            **overrides
+        } for product in batch]
+        prices = calculate_prices(
+            [row["base_price"] for row in rows],
+            [row["profit_type"] for row in rows],
+            [row["profit_value"] for row in rows],
+            [row["iva_percentage"] for row in rows]
+        )
+        now = datetime.now(timezone.utc)
+        operations = []
+        for product, row, price in zip(batch, rows, prices):
+            # Solo se escriben el precio y los valores enviados; los defaults solo sirven para calcular
+            changes = {key: value for key, value in {**overrides, "price": price}.items() if product.get(key) != value}
+            if changes:
+                operations.append(UpdateOne({"id": product["id"]}, {"$set": {**changes, "updated_at": now}}))
+        if operations:
+            written = await db.products.bulk_write(operations, ordered=False)
+            result["updated"] += written.modified_count
+        result["matched"] += len(batch)
+    
+    batch = []
+    cursor = db.products.find(
+        {**query, "base_price": {"$type": "number"}},
+        {"_id": 0, "id": 1, "base_price": 1, "profit_type": 1, "profit_value": 1, "iva_percentage": 1, "price": 1}
+    ).batch_size(REPRICE_BATCH_SIZE)
+    async for product in cursor:
+        batch.append(product)
+        if len(batch) >= REPRICE_BATCH_SIZE:
+            await write(batch)
+            batch = []
+    await write(batch)
+    
+    if result["updated"]:
+        await bump_collection_version("products")
+    return result
+
 @api_router.post("/admin/categories", response_model=Category)
 async def create_category(
     category_data: CategoryCreate,
@@ -1200,22 +3239,28 @@ async def create_category(
     if existing:
         raise HTTPException(status_code=400, detail="Category slug already exists")
     
-    category_id = str(uuid.uuid4())
+    category_id = new_id()
     category_doc = {
         "id": category_id,
         "name": category_data.name,
         "slug": category_data.slug,
         "description": category_data.description,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
+    category_doc["updated_at"] = category_doc["created_at"]
     
     await db.categories.insert_one(category_doc)
+    await bump_collection_version("categories")
     return Category(**category_doc)
 
 @api_router.get("/admin/categories", response_model=List[Category])
-async def get_all_categories(admin_user: User = Depends(get_admin_user)):
-    categories = await db.categories.find({}, {"_id": 0}).to_list(1000)
-    return categories
+async def get_all_categories(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    admin_user: User = Depends(get_admin_user)
+):
+    return await fetch_page(db.categories, {}, response, limit, after, direction=ASCENDING)
 
 @api_router.delete("/admin/categories/{category_id}")
 async def delete_category(
@@ -1225,30 +3270,160 @@ async def delete_category(
     result = await db.categories.delete_one({"id": category_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Category not found")
+    await record_tombstone("categories", category_id)
+    await bump_collection_version("categories")
     
     return {"message": "Category deleted successfully"}
 
 @api_router.get("/admin/stats")
 async def get_admin_stats(admin_user: User = Depends(get_admin_user)):
-    total_users = await db.users.count_documents({})
-    total_clients = await db.users.count_documents({"role": "cliente"})
-    total_suppliers = await db.users.count_documents({"role": "proveedor"})
-    total_orders = await db.orders.count_documents({})
-    total_products = await db.products.count_documents({})
-    pending_requests = await db.registration_requests.count_documents({"status": "pendiente"})
+    # Contadores materializados: una sola lectura sin importar el tamaño del historial
+    stats = await db.admin_stats.find_one({"_id": "global"})
+    if not stats:
+        stats = await reconcile_stats()
+    
+    users_by_role = stats.get("users_by_role", {})
+    revenue_by_status = stats.get("revenue_by_status", {})
+    
+    return {
+        "total_users": stats.get("users_total", 0),
+        "total_clients": users_by_role.get("cliente", 0),
+        "total_suppliers": users_by_role.get("proveedor", 0),
+        "total_orders": stats.get("orders_total", 0),
+        "total_products": stats.get("products_total", 0),
+        "pending_requests": stats.get("registration_requests_by_status", {}).get("pendiente", 0),
+        "total_revenue": round(revenue_by_status.get("completado", 0), 2),
+        "orders_by_status": {key: value for key, value in stats.get("orders_by_status", {}).items() if value},
+        "revenue_by_status": {key: round(value, 2) for key, value in revenue_by_status.items() if round(value, 2)}
+    }
+
+@api_router.post("/admin/stats/reconcile")
+async def reconcile_admin_stats(admin_user: User = Depends(get_admin_user)):
+    stats = await reconcile_stats()
+    stats.pop("_id", None)
+    return stats
+
+@api_router.get("/admin/analytics/orders")
+async def get_order_analytics(
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    granularity: str = Query("day", pattern="^(day|week|month)$"),
+    supplier_id: Optional[str] = None,
+    category: Optional[str] = None,
+    status: Optional[str] = None,
+    admin_user: User = Depends(get_admin_user)
+):
+    try:
+        end = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else datetime.now(timezone.utc).date()
+        start = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else end - timedelta(days=29)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Las fechas deben tener formato YYYY-MM-DD")
+    if start > end:
+        raise HTTPException(status_code=400, detail="'from' debe ser anterior a 'to'")
+    
+    match = {
+        "day": {"$gte": start.isoformat(), "$lte": end.isoformat()},
+        "category": category or ROLLUP_ALL_CATEGORIES
+    }
+    if supplier_id:
+        match["supplier_id"] = supplier_id
+    if status:
+        match["status"] = status
+    
+    rows = await db.order_rollups.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"day": "$day", "status": "$status"},
+            "orders": {"$sum": "$orders"},
+            "revenue": {"$sum": "$revenue"},
+            "items": {"$sum": "$items"}
+        }}
+    ]).to_list(None)
+    
+    series = {}
+    for row in rows:
+        day = datetime.strptime(row["_id"]["day"], "%Y-%m-%d").date()
+        if granularity == "week":
+            period = (day - timedelta(days=day.weekday())).isoformat()
+        elif granularity == "month":
+            period = day.strftime("%Y-%m")
+        else:
+            period = day.isoformat()
+        point = series.setdefault(period, {"period": period, "orders": 0, "revenue": 0, "items": 0, "by_status": {}})
+        point["orders"] += row["orders"]
+        point["revenue"] += row["revenue"]
+        point["items"] += row["items"]
+        by_status = point["by_status"].setdefault(row["_id"]["status"], {"orders": 0, "revenue": 0})
+        by_status["orders"] += row["orders"]
+        by_status["revenue"] += row["revenue"]
+    
+    points = sorted(series.values(), key=lambda point: point["period"])
+    for point in points:
+        point["revenue"] = round(point["revenue"], 2)
+        point["by_status"] = {
+            key: {"orders": value["orders"], "revenue": round(value["revenue"], 2)}
+            for key, value in point["by_status"].items() if value["orders"]
+        }
     
-    # Calculate revenue
-    orders = await db.orders.find({"status": "completado"}, {"_id": 0}).to_list(10000)
-    total_revenue = sum(order.get("total", 0) for order in orders)
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "granularity": granularity,
+        "series": [point for point in points if point["orders"]]
+    }
+
+@api_router.post("/admin/analytics/rebuild")
+async def rebuild_order_analytics(admin_user: User = Depends(get_admin_user)):
+    processed = await rebuild_order_rollups()
+    return {"message": "Rollups reconstruidos", "orders": processed}
+
+@api_router.get("/admin/export/{entity}")
+async def export_admin_data(
+    entity: str,
+    export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    admin_user: User = Depends(get_admin_user)
+):
+    if entity not in EXPORTS:
+        raise HTTPException(status_code=404, detail="Exportación no disponible")
+    
+    extension = "csv" if export_format == "csv" else "ndjson"
+    filename = f"{entity}-{datetime.now(timezone.utc).strftime('%Y%m%d')}.{extension}"
+    return StreamingResponse(
+        stream_export(entity, export_format),
+        media_type="text/csv; charset=utf-8" if export_format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.get("/admin/indexes")
+async def get_index_report(admin_user: User = Depends(get_admin_user)):
+    existing = {}
+    for collection_name in REQUIRED_INDEXES:
+        info = await db[collection_name].index_information()
+        existing[collection_name] = sorted(info.keys())
     
+    queries = []
+    for query in HOT_QUERIES:
+        try:
+            queries.append(await explain_hot_query(query))
+        except PyMongoError as e:
+            queries.append({"name": query["name"], "collection": query["collection"], "error": str(e)})
+    
+    return {
+        "declared": {name: [index.document["name"] for index in indexes] for name, indexes in REQUIRED_INDEXES.items()},
+        "existing": existing,
+        "queries": queries
+    }
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(admin_user: User = Depends(get_admin_user)):
     return {
-        "total_users": total_users,
-        "total_clients": total_clients,
-        "total_suppliers": total_suppliers,
-        "total_orders": total_orders,
-        "total_products": total_products,
-        "pending_requests": pending_requests,
-        "total_revenue": total_revenue
+        "user_cache": user_cache.stats(),
+        "bcrypt_pool": bcrypt_pool.stats(),
+        "supplier_products_cache": supplier_products_cache.stats(),
+        "category_cache": category_cache.stats(),
+        "collection_version_cache": collection_version_cache.stats(),
+        "notification_dispatcher": notification_dispatcher.stats(),
+        "event_hub": event_hub.stats()
     }
 
 # Include router
@@ -1260,6 +3435,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Content-Range", "Content-Length", "ETag", "Last-Modified"],
 )
 
 logging.basicConfig(
@@ -1270,4 +3446,10 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    # Guardar las notificaciones pendientes antes de cerrar la conexión
+    await notification_dispatcher.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    client.close()
+    bcrypt_pool.shutdown()
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+import sys
+from pathlib import Path
+
+import mongomock_motor
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+ADMIN = {"email": "admin@mardecortez.com", "password": "admin123"}
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    # Base en memoria por prueba; el arranque crea índices y el admin por defecto
+    monkeypatch.setattr(server, "db", mongomock_motor.AsyncMongoMockClient(tz_aware=True)["test_database"])
+    monkeypatch.setattr(server, "blob_store", server.LocalBlobStore(tmp_path / "blobs"))
+    # El apagado de la app cierra el pool de bcrypt y cancela las tareas: estado nuevo por prueba
+    monkeypatch.setattr(server, "bcrypt_pool", server.BcryptPool(server.BCRYPT_MAX_WORKERS))
+    monkeypatch.setattr(server, "background_tasks", [])
+    for cache in (server.user_cache, server.supplier_products_cache, server.category_cache, server.collection_version_cache):
+        cache.invalidate()
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+def login(client, email, password):
+    response = client.post("/api/auth/login", json={"email": email, "password": password})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['token']}"}
+
+
+@pytest.fixture
+def admin_headers(client):
+    return login(client, ADMIN["email"], ADMIN["password"])
+
+
+@pytest.fixture
+def create_user(client, admin_headers):
+    def create(role, email, name=None):
+        response = client.post("/api/admin/users", headers=admin_headers, json={
+            "email": email, "password": "secret", "name": name or email, "role": role
+        })
+        assert response.status_code == 200, response.text
+        return login(client, email, "secret")
+    return create
@@ -0,0 +1,29 @@
+import server
+
+
+def test_cached_category_list_makes_no_database_calls(client, monkeypatch):
+    assert client.get("/api/categories").status_code == 200
+
+    def fail(*args, **kwargs):
+        raise AssertionError("category list hit the database")
+
+    database = server.db
+    monkeypatch.setattr(server, "db", None)
+    monkeypatch.setattr(server, "fetch_page", fail)
+    response = client.get("/api/categories")
+    assert response.status_code == 200
+    assert client.get("/api/categories", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    monkeypatch.setattr(server, "db", database)
+
+
+def test_category_write_is_visible_at_once_on_the_same_worker(client, admin_headers):
+    etag = client.get("/api/categories").headers["ETag"]
+    created = client.post("/api/admin/categories", headers=admin_headers, json={"name": "Bebidas", "slug": "bebidas"})
+    assert created.status_code == 200, created.text
+
+    response = client.get("/api/categories", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "bebidas" in [category["slug"] for category in response.json()]
+
+    client.delete(f"/api/admin/categories/{created.json()['id']}", headers=admin_headers)
+    assert "bebidas" not in [category["slug"] for category in client.get("/api/categories").json()]
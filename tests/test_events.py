@@ -0,0 +1,48 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def me(client, headers):
+    return server.User(**client.get("/api/auth/me", headers=headers).json())
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return [event["type"] for event in events]
+
+
+def test_quotation_event_reaches_only_quotation_readers(client, create_user):
+    supplier = create_user("proveedor", "proveedor@example.com")
+    other = create_user("proveedor", "otro@example.com")
+    customer = create_user("cliente", "cliente@example.com")
+    order = client.post("/api/orders", headers=customer, json={
+        "products": [{"product_name": "Cuerda", "quantity": 1, "is_custom": True}]
+    }).json()
+    client.put(f"/api/orders/{order['id']}/take", headers=supplier, json={"status": "en_proceso"})
+
+    queues = {}
+    for name, headers in (("supplier", supplier), ("other", other), ("customer", customer)):
+        _, queues[name] = server.event_hub.subscribe(me(client, headers))
+    response = client.post(f"/api/orders/{order['id']}/quotation", headers=supplier,
+                           params={"amount": 1234, "notes": "secreto"},
+                           files={"file": ("q.pdf", b"%PDF-1.4", "application/pdf")})
+    assert response.status_code == 200, response.text
+
+    assert "quotation.created" in drain(queues["supplier"])
+    assert "quotation.created" in drain(queues["customer"])
+    assert "quotation.created" not in drain(queues["other"])
+
+
+def test_events_query_token_must_be_a_stream_token(client, admin_headers):
+    session_token = admin_headers["Authorization"].split()[1]
+    with pytest.raises(HTTPException):
+        client.portal.call(server.user_from_token, session_token, "events")
+
+    stream_token = client.post("/api/events/token", headers=admin_headers).json()["token"]
+    assert client.portal.call(server.user_from_token, stream_token, "events").role == "admin"
+    # El token corto no sirve como sesión
+    assert client.get("/api/auth/me", headers={"Authorization": f"Bearer {stream_token}"}).status_code == 401
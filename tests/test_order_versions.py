@@ -0,0 +1,82 @@
+import pytest
+
+import server
+
+
+@pytest.fixture
+def order(client, create_user):
+    supplier = create_user("proveedor", "proveedor@example.com", "Proveedor")
+    customer = create_user("cliente", "cliente@example.com", "Cliente")
+    product = client.post("/api/products", headers=supplier, json={
+        "name": "Atún", "description": "Lata", "category": "alimentos", "sku": "AT-1",
+        "base_price": 10, "profit_type": "percentage", "profit_value": 10
+    })
+    assert product.status_code == 200, product.text
+    response = client.post("/api/orders", headers=customer, json={
+        "products": [{"product_id": product.json()["id"], "product_name": "Atún", "quantity": 2}]
+    })
+    assert response.status_code == 200, response.text
+    return {"id": response.json()["id"], "supplier": supplier, "customer": customer}
+
+
+def test_new_order_starts_at_version_zero(client, order, admin_headers):
+    response = client.get(f"/api/orders/{order['id']}", headers=admin_headers)
+    assert response.json()["version"] == 0
+
+
+def test_admin_status_update_with_current_version(client, order, admin_headers):
+    response = client.put(f"/api/admin/orders/{order['id']}/status", headers=admin_headers,
+                          json={"status": "en_proceso", "expected_version": 0})
+    assert response.status_code == 200
+    assert response.json()["version"] == 1
+
+
+def test_admin_status_update_with_stale_version(client, order, admin_headers):
+    client.put(f"/api/admin/orders/{order['id']}/status", headers=admin_headers, json={"status": "en_proceso"})
+    response = client.put(f"/api/admin/orders/{order['id']}/status", headers=admin_headers,
+                          json={"status": "cancelado", "expected_version": 0})
+    assert response.status_code == 409
+    assert client.get(f"/api/orders/{order['id']}", headers=admin_headers).json()["status"] == "en_proceso"
+
+
+def test_admin_status_update_on_missing_order(client, admin_headers):
+    response = client.put("/api/admin/orders/missing/status", headers=admin_headers,
+                          json={"status": "en_proceso", "expected_version": 0})
+    assert response.status_code == 404
+
+
+def test_supplier_status_update_with_stale_version(client, order, admin_headers):
+    client.put(f"/api/admin/orders/{order['id']}/status", headers=admin_headers, json={"status": "recibido"})
+    response = client.put(f"/api/orders/{order['id']}/status", headers=order["supplier"],
+                          json={"status": "en_proceso", "expected_version": 0})
+    assert response.status_code == 409
+
+
+def test_supplier_status_update_claims_order(client, order):
+    response = client.put(f"/api/orders/{order['id']}/status", headers=order["supplier"],
+                          json={"status": "en_proceso", "expected_version": 0})
+    assert response.status_code == 200
+    assert response.json()["version"] == 1
+    assert response.json()["supplier_name"] == "Proveedor"
+
+
+def test_take_with_stale_version(client, order, admin_headers):
+    client.put(f"/api/admin/orders/{order['id']}/status", headers=admin_headers, json={"status": "recibido"})
+    response = client.put(f"/api/orders/{order['id']}/take", headers=order["supplier"],
+                          json={"status": "en_proceso", "product_prices": {"0": 5}, "expected_version": 0})
+    assert response.status_code == 409
+
+
+def test_take_order_taken_by_another_supplier(client, order, create_user):
+    other = create_user("proveedor", "otro@example.com", "Otro")
+    client.put(f"/api/orders/{order['id']}/status", headers=order["supplier"], json={"status": "en_proceso"})
+    response = client.put(f"/api/orders/{order['id']}/take", headers=other, json={"status": "en_proceso"})
+    assert response.status_code == 400
+
+
+def test_order_without_version_field_counts_as_zero(client, order, admin_headers):
+    client.portal.call(server.db.orders.update_one, {"id": order["id"]}, {"$unset": {"version": ""}})
+    response = client.put(f"/api/admin/orders/{order['id']}/status", headers=admin_headers,
+                          json={"status": "en_proceso", "expected_version": 0})
+    assert response.status_code == 200
+    assert response.json()["version"] == 1
@@ -0,0 +1,58 @@
+import base64
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def legacy_quotations(client, create_user):
+    customer = create_user("cliente", "cliente@example.com")
+    customer_id = client.get("/api/auth/me", headers=customer).json()["id"]
+    client.portal.call(server.db.orders.insert_one, {
+        "id": "o1", "order_number": "ORD-1", "client_id": customer_id, "supplier_id": "s1", "status": "en_proceso"
+    })
+    for quotation_id, content in (("q1", b"%PDF-1.4 uno"), ("q2", b"%PDF-1.4 dos")):
+        client.portal.call(server.db.quotations.insert_one, {
+            "id": quotation_id, "order_id": "o1", "supplier_id": "s1", "file_name": f"{quotation_id}.pdf",
+            "file_data": base64.b64encode(content).decode("ascii")
+        })
+    return customer
+
+
+def quotation(client, quotation_id):
+    return client.portal.call(server.db.quotations.find_one, {"id": quotation_id}, {"_id": 0})
+
+
+def test_migration_moves_files_to_the_blob_store(client, legacy_quotations):
+    client.portal.call(server.migrate_quotation_files)
+
+    migrated = quotation(client, "q1")
+    assert "file_data" not in migrated
+    assert migrated["size"] == len(b"%PDF-1.4 uno")
+    assert migrated["content_type"] == "application/pdf"
+
+    response = client.get("/api/orders/o1/quotations/q1/file", headers=legacy_quotations)
+    assert response.status_code == 200
+    assert response.content == b"%PDF-1.4 uno"
+    partial = client.get("/api/orders/o1/quotations/q2/file", headers={**legacy_quotations, "Range": "bytes=9-"})
+    assert partial.status_code == 206
+    assert partial.content == b"dos"
+
+
+def test_failed_rows_keep_the_inline_fallback(client, legacy_quotations, monkeypatch):
+    save = server.blob_store.save
+
+    async def fail_on_second(upload, max_bytes):
+        if (await upload.read()).endswith(b"dos"):
+            raise OSError("disk full")
+        await upload.seek(0)
+        return await save(upload, max_bytes)
+
+    monkeypatch.setattr(server.blob_store, "save", fail_on_second)
+    client.portal.call(server.migrate_quotation_files)
+
+    assert "file_data" not in quotation(client, "q1")
+    assert "file_data" in quotation(client, "q2")
+    response = client.get("/api/orders/o1/quotations/q2/file", headers=legacy_quotations)
+    assert response.content == b"%PDF-1.4 dos"
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def seed_order(client, order_id, status, created_at):
+    order = {
+        "id": order_id, "order_number": order_id, "client_id": "c", "client_name": "c",
+        "supplier_id": "s", "products": [{"product_name": "agua", "category": "bebidas", "quantity": 2, "price": 1.5}],
+        "total": 3.0, "status": status, "version": 0, "created_at": created_at, "updated_at": created_at
+    }
+    client.portal.call(server.db.orders.insert_one, order)
+
+
+def rollups(client):
+    rows = client.portal.call(lambda: server.db.order_rollups.find({}, {"_id": 0}).to_list(None))
+    return sorted((row["day"], row["supplier_id"], row["category"], row["status"], row["orders"], row["revenue"], row["items"])
+                  for row in rows if row["orders"] or row["items"])
+
+
+def test_rebuild_keeps_changes_made_during_the_scan(client, monkeypatch):
+    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+    seed_order(client, "o1", "pendiente", yesterday)
+    seed_order(client, "o2", "pendiente", yesterday - timedelta(days=1))
+    compute = server.compute_order_rollups
+
+    async def scan_then_change(query):
+        result = await compute(query)
+        if query == {}:
+            # Cambio que llega después de que el recorrido ya leyó la orden
+            before = await server.db.orders.find_one_and_update(
+                {"id": "o1"}, {"$set": {"status": "recibido", "updated_at": datetime.now(timezone.utc)}},
+                projection={"_id": 0}
+            )
+            await server.record_order_change(before, {**before, "status": "recibido"})
+        return result
+
+    monkeypatch.setattr(server, "compute_order_rollups", scan_then_change)
+    client.portal.call(server.rebuild_order_rollups)
+    monkeypatch.setattr(server, "compute_order_rollups", compute)
+
+    rebuilt = rollups(client)
+    assert all(row[3] == "recibido" for row in rebuilt if row[0] == str(yesterday)[:10])
+    client.portal.call(server.rebuild_order_rollups)
+    assert rollups(client) == rebuilt
+
+
+def test_rebuild_keeps_rollup_indexes(client):
+    seed_order(client, "o1", "pendiente", datetime.now(timezone.utc))
+    client.portal.call(server.rebuild_order_rollups)
+    indexes = client.portal.call(server.db.order_rollups.index_information)
+    assert {"bucket_unique", "category_day"} <= set(indexes)
+    collections = client.portal.call(server.db.list_collection_names)
+    assert not [name for name in collections if name.startswith("order_rollups_rebuild")]
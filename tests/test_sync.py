@@ -0,0 +1,108 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def sync(client, headers, **params):
+    response = client.get("/api/sync", headers=headers, params=params)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def insert_category(client, category_id, updated_at):
+    client.portal.call(server.db.categories.insert_one, {
+        "id": category_id, "name": category_id, "slug": category_id,
+        "created_at": updated_at, "updated_at": updated_at
+    })
+
+
+def ids(docs):
+    return [doc["id"] for doc in docs]
+
+
+def test_sync_token_round_trip():
+    moment = datetime(2025, 1, 2, 3, 4, 5, 123000, tzinfo=timezone.utc)
+    watermarks = {"orders": [moment, "abc"], "products": [None, ""]}
+    assert server.decode_sync_token(server.encode_sync_token(watermarks)) == watermarks
+
+
+@pytest.mark.parametrize("payload", [b"not json", b"[1, 2]", b'{"orders": 5}'])
+def test_invalid_sync_token(payload):
+    token = base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+    with pytest.raises(HTTPException) as error:
+        server.decode_sync_token(token)
+    assert error.value.status_code == 400
+
+
+def test_first_sync_is_full_snapshot(client, admin_headers):
+    now = datetime.now(timezone.utc)
+    insert_category(client, "a", now - timedelta(days=2))
+    insert_category(client, "b", now - timedelta(days=1))
+    data = sync(client, admin_headers)
+    assert data["full"] is True
+    assert data["has_more"] is False
+    assert ids(data["changes"]["categories"]) == ["a", "b"]
+
+
+def test_watermarks_stay_behind_clock_skew(client, admin_headers):
+    insert_category(client, "a", datetime.now(timezone.utc))
+    token = sync(client, admin_headers)["token"]
+    limit = datetime.now(timezone.utc) - timedelta(seconds=server.SYNC_CLOCK_SKEW_SECONDS)
+    for value, _ in server.decode_sync_token(token).values():
+        assert value <= limit
+
+
+def test_sync_returns_writes_in_flight_but_not_older_ones(client, admin_headers):
+    token = sync(client, admin_headers)["token"]
+    now = datetime.now(timezone.utc)
+    # Escrita justo antes de emitir el token pero visible después
+    insert_category(client, "late", now - timedelta(seconds=server.SYNC_CLOCK_SKEW_SECONDS - 1))
+    insert_category(client, "old", now - timedelta(hours=1))
+    data = sync(client, admin_headers, since=token)
+    assert data["full"] is False
+    assert ids(data["changes"]["categories"]) == ["late"]
+
+
+def test_sync_pages_through_equal_timestamps(client, admin_headers):
+    moment = datetime.now(timezone.utc) - timedelta(days=1)
+    for category_id in ("c1", "c2", "c3"):
+        insert_category(client, category_id, moment)
+
+    seen, token = [], None
+    while True:
+        data = sync(client, admin_headers, limit=1, **({"since": token} if token else {}))
+        seen += ids(data["changes"]["categories"])
+        token = data["token"]
+        if not data["has_more"]:
+            break
+    assert seen == ["c1", "c2", "c3"]
+
+
+def test_sync_reports_tombstones_for_the_caller(client, create_user):
+    customer = create_user("cliente", "cliente@example.com")
+    customer_id = client.get("/api/auth/me", headers=customer).json()["id"]
+    token = sync(client, customer)["token"]
+
+    client.portal.call(server.record_tombstone, "notifications", "mine", [customer_id])
+    client.portal.call(server.record_tombstone, "notifications", "theirs", ["someone-else"])
+    client.portal.call(server.record_tombstone, "categories", "gone")
+    data = sync(client, customer, since=token)
+    assert data["deleted"]["notifications"] == ["mine"]
+    assert data["deleted"]["categories"] == ["gone"]
+
+
+def test_expired_token_forces_full_sync(client, admin_headers):
+    expired = datetime.now(timezone.utc) - timedelta(days=server.TOMBSTONE_RETENTION_DAYS + 1)
+    token = server.encode_sync_token({"tombstones": [expired, ""], "categories": [expired, ""]})
+    assert sync(client, admin_headers, since=token)["full"] is True
+
+
+def test_token_with_text_watermark_forces_full_sync(client, admin_headers):
+    raw = json.dumps({"tombstones": ["2025-01-01T00:00:00+00:00", ""]}).encode("utf-8")
+    token = base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+    assert sync(client, admin_headers, since=token)["full"] is True